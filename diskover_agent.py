@@ -14,8 +14,27 @@ import os
 import sys
 import time
 import random
+import re
 import warnings
-import multiprocessing
+import threading
+import collections
+import struct
+import bisect
+import hashlib
+import sqlite3
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+from itertools import compress
+try:
+    maketrans = bytes.maketrans
+except AttributeError:
+    from string import maketrans
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
 
 
 IS_PY3 = sys.version_info >= (3, 0)
@@ -23,10 +42,475 @@ if IS_PY3:
 	unicode = str
 
 
+# binary listing format, see BinaryDecoder
+BINARY_CONTENT_TYPE = 'application/x-diskover-listing'
+BINARY_MAGIC = b'DSKL'
+BINARY_FLAG_STAT = 1
+# magic, version, flags
+BINARY_HEADER = struct.Struct('<4sBB')
+# block type, entry count, payload length
+BINARY_BLOCK = struct.Struct('<BII')
+# struct format codes of the stat fields in a stat listing, in the
+# order of the StatEntry st_ fields
+BINARY_STAT_CODES = 'QdddQIII'
+BINARY_STAT_SIZE = struct.calcsize('<' + BINARY_STAT_CODES)
+BLOCK_ENTRIES = 1
+BLOCK_ROOT = 2
+BLOCK_END = 3
+BLOCK_STATUS = 4
+BLOCK_DU = 5
+# size, disk usage, file count, dir count and newest mtime of a du record
+BINARY_DU = struct.Struct('<QQQQd')
+# response header with the cursor of the next listing page
+CURSOR_HEADER = 'X-Diskover-Cursor'
+# query parameters of listing filters, see filter_query
+FILTER_PARAMS = ('xdir', 'xdirre', 'file', 'xfile', 'minsize', 'maxsize', 'minage', 'maxage')
+# translation tables from entry type bytes to selector masks
+DIR_MASK = maketrans(b'df', b'\x01\x00')
+FILE_MASK = maketrans(b'df', b'\x00\x01')
+
+# directory entry with stat fields from a stat listing
+StatEntry = collections.namedtuple('StatEntry', [
+    'name',
+    'type',
+    'st_size',
+    'st_mtime',
+    'st_atime',
+    'st_ctime',
+    'st_ino',
+    'st_nlink',
+    'st_uid',
+    'st_gid',
+])
+
+# entries added to and removed from a directory, from incremental_walk
+DirDelta = collections.namedtuple('DirDelta', [
+    'path',
+    'added_dirs',
+    'added_files',
+    'removed_dirs',
+    'removed_files',
+])
+
+# rolled up totals of a directory from a du request
+DuEntry = collections.namedtuple('DuEntry', [
+    'path',
+    'size',
+    'size_du',
+    'files',
+    'dirs',
+    'mtime',
+])
+
+
+def parse_stat_line(line):
+    """Parses a line of a stat listing (type, size, mtime, atime, ctime,
+    inode, nlink, uid and gid separated by tabs, followed by the name)
+    into a StatEntry. Returns None for a malformed line, such as the
+    parts of a name with a newline, which the text format can not carry.
+    """
+    f = line.split('\t', 9)
+    try:
+        return StatEntry(f[9], f[0], int(f[1]), float(f[2]), float(f[3]),
+                         float(f[4]), int(f[5]), int(f[6]), int(f[7]), int(f[8]))
+    except (IndexError, ValueError):
+        warnings.warn("skipping malformed stat line %r" % line)
+        return None
+
+
+def fsname(name):
+    """Returns a name from a binary listing as a native string. On
+    Python 3 bytes that are not valid utf-8 are kept as surrogates
+    like os.fsdecode does, so the name maps back to the same bytes.
+    """
+    if IS_PY3:
+        return name.decode('utf-8', 'surrogateescape')
+    return name
+
+
+def fsbytes(name):
+    """Returns a name as bytes, the inverse of fsname."""
+    if isinstance(name, unicode):
+        if IS_PY3:
+            return name.encode('utf-8', 'surrogateescape')
+        return name.encode('utf-8')
+    return name
+
+
+def filter_query(filters):
+    """Returns the query string for a dict of listing filters applied
+    by the storage agent, or '' if filters is empty. Keys are filter
+    parameters and values a value or list of values: xdir (directory
+    name globs) and xdirre (directory name regexes) drop directories so
+    walks do not descend into them, file (name globs, a file has to
+    match one), xfile (name globs), minsize and maxsize (bytes), minage
+    and maxage (seconds since mtime) filter regular files, e.g.
+    {'xdir': ['.snapshot', '.git'], 'xfile': '*.tmp', 'minsize': 1}.
+    filters can also be a query string returned by filter_query, it is
+    returned as is. Raises ValueError for an unknown filter, a size or
+    age that is not a number or an invalid regex.
+    """
+    if not filters:
+        return ''
+    if isinstance(filters, (str, unicode)):
+        return filters
+    for name in filters:
+        if name not in FILTER_PARAMS:
+            raise ValueError("unknown filter %s" % name)
+    params = []
+    # in FILTER_PARAMS order so the same filters give the same ETag
+    for name in FILTER_PARAMS:
+        values = filters.get(name)
+        if values is None:
+            continue
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        for value in values:
+            if name in ('minsize', 'maxsize'):
+                value = str(int(value))
+            elif name in ('minage', 'maxage'):
+                value = repr(float(value))
+            elif name == 'xdirre':
+                try:
+                    re.compile(value)
+                except re.error as e:
+                    raise ValueError("invalid xdirre regex %r (%s)" % (value, e))
+            elif not isinstance(value, (bytes, unicode)):
+                value = str(value)
+            params.append('%s=%s' % (name, quote(fsbytes(value), safe='')))
+    return '&'.join(params)
+
+
+def join_query(*parts):
+    """Returns the query string of the non-empty parts joined by &."""
+    return '&'.join([p for p in parts if p]) or None
+
+
+class BinaryDecoder(object):
+    """Incremental decoder for the binary listing format. The stream
+    starts with a BINARY_HEADER followed by blocks of a BINARY_BLOCK
+    header (block type, entry count and payload length) and the payload.
+    A BLOCK_ENTRIES payload holds a type byte (d or f) per entry, the
+    names separated by NUL bytes and, in a stat listing, an array per
+    stat field. BLOCK_ROOT and BLOCK_END start and end walk records,
+    batch records start with a BLOCK_STATUS instead. BLOCK_DU holds a du
+    record.
+    """
+
+    def __init__(self):
+        self.buf = b''
+        self.header = False
+        self.stat = False
+
+    def feed(self, data):
+        """Adds data from the stream and returns a list of (block type,
+        value) tuples for the blocks completed by it. The value is a
+        (dirs, files) tuple for BLOCK_ENTRIES, the root path for
+        BLOCK_ROOT, a (status, path) tuple for BLOCK_STATUS, a DuEntry
+        for BLOCK_DU and None for BLOCK_END.
+        """
+        buf = self.buf + data if self.buf else data
+        pos = 0
+        if not self.header:
+            if len(buf) < BINARY_HEADER.size:
+                self.buf = buf
+                return []
+            magic, version, flags = BINARY_HEADER.unpack_from(buf, 0)
+            if magic != BINARY_MAGIC:
+                raise ValueError("invalid binary listing")
+            self.stat = bool(flags & BINARY_FLAG_STAT)
+            self.header = True
+            pos = BINARY_HEADER.size
+        blocks = []
+        end = len(buf)
+        while pos + BINARY_BLOCK.size <= end:
+            blocktype, count, length = BINARY_BLOCK.unpack_from(buf, pos)
+            start = pos + BINARY_BLOCK.size
+            if start + length > end:
+                break
+            payload = buf[start:start+length]
+            pos = start + length
+            if blocktype == BLOCK_ENTRIES:
+                blocks.append((blocktype, self.decode_entries(count, payload)))
+            elif blocktype == BLOCK_ROOT:
+                blocks.append((blocktype, fsname(payload)))
+            elif blocktype == BLOCK_STATUS:
+                blocks.append((blocktype, (count, fsname(payload))))
+            elif blocktype == BLOCK_DU:
+                blocks.append((blocktype, DuEntry(fsname(payload[BINARY_DU.size:]),
+                                                  *BINARY_DU.unpack_from(payload))))
+            else:
+                blocks.append((blocktype, None))
+        self.buf = buf[pos:]
+        return blocks
+
+    def decode_entries(self, count, payload):
+        """Decodes a BLOCK_ENTRIES payload to (dirs, files) lists of names,
+        or of StatEntry tuples in a stat listing.
+        """
+        if not count:
+            return [], []
+        types = payload[:count]
+        nameslen = len(payload) - count
+        if self.stat:
+            nameslen -= count * BINARY_STAT_SIZE
+        names = fsname(payload[count:count+nameslen]).split('\0')
+        if self.stat:
+            pos = count + nameslen
+            columns = []
+            for code in BINARY_STAT_CODES:
+                fmt = '<%d%s' % (count, code)
+                columns.append(struct.unpack_from(fmt, payload, pos))
+                pos += struct.calcsize(fmt)
+            names = list(map(StatEntry, names, types.decode('ascii'), *columns))
+        return (list(compress(names, bytearray(types.translate(DIR_MASK)))),
+                list(compress(names, bytearray(types.translate(FILE_MASK)))))
+
+
+def ring_hash(key):
+    """Returns the position of key on a HashRing, stable across processes
+    unlike hash()
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8', 'surrogateescape') if IS_PY3 else key.encode('utf-8')
+    return struct.unpack_from('<Q', hashlib.md5(key).digest())[0]
+
+
+class HashRing(object):
+    """Consistent hash ring that maps paths to hosts so the same subtree
+    is always listed by the same storage node and its caches. Each host
+    has vnodes points on the ring and a path belongs to the host of the
+    next point after the hash of its first depth components, so every
+    subtree below that depth stays on one host. Adding or removing a
+    host only moves the paths next to its points.
+    """
+
+    def __init__(self, hosts=(), vnodes=100, depth=3):
+        self.vnodes = vnodes
+        self.depth = depth
+        # sorted points and the host owning each point
+        self.points = []
+        self.owners = {}
+        self.members = set()
+        for host in hosts:
+            self.add(host)
+
+    def add(self, host):
+        if host in self.members:
+            return
+        self.members.add(host)
+        for i in range(self.vnodes):
+            point = ring_hash('%s#%d' % (host, i))
+            if point not in self.owners:
+                self.owners[point] = host
+                bisect.insort(self.points, point)
+
+    def remove(self, host):
+        self.members.discard(host)
+        self.points = [p for p in self.points if self.owners[p] != host]
+        self.owners = dict((p, self.owners[p]) for p in self.points)
+
+    def key(self, path):
+        """Returns the part of path that is hashed, its first depth
+        components
+        """
+        return '/'.join([part for part in path.split('/') if part][:self.depth])
+
+    def hosts(self, path):
+        """Generator that yields every host once in ring order starting at
+        the host path belongs to, the following hosts are the fallbacks.
+        """
+        n = len(self.points)
+        if not n:
+            return
+        start = bisect.bisect(self.points, ring_hash(self.key(path)))
+        seen = set()
+        for i in range(n):
+            host = self.owners[self.points[(start + i) % n]]
+            if host not in seen:
+                seen.add(host)
+                yield host
+                if len(seen) == len(self.members):
+                    return
+
+
+class LoadBalancer(object):
+    """Picks the storage agent host for each request and tracks the
+    health of the hosts. It is thread safe and can be shared by the
+    connections of a parallel walk. Strategies:
+
+    random  a random host
+    least   the host with the least outstanding requests
+    ewma    the host with the lowest response time EWMA weighted by its
+            outstanding requests
+    p2c     the better of two random hosts by outstanding requests, then
+            response time EWMA (power of two choices)
+    hash    the host the path belongs to on the HashRing ring, or the next
+            healthy host on the ring
+
+    A host that fails maxfails requests in a row is ejected for
+    ejecttime seconds, after that a single request probes it and it is
+    ejected again if that request fails. When no host is healthy the
+    ejected host whose ejection ends first is probed, so requests are
+    not failed without being sent, e.g. with a single host. Requests
+    wait while the only hosts left have a probe in flight.
+    """
+    STRATEGIES = ('random', 'least', 'ewma', 'p2c', 'hash')
+
+    def __init__(self, hosts, strategy='random', maxfails=3, ejecttime=30,
+                 decay=0.3, ring=None):
+        if strategy not in self.STRATEGIES:
+            raise ValueError("unknown load balancing strategy %s" % strategy)
+        self.hosts = list(hosts)
+        self.strategy = strategy
+        if strategy == 'hash' and ring is None:
+            ring = HashRing(hosts)
+        self.ring = ring
+        self.maxfails = maxfails
+        self.ejecttime = ejecttime
+        self.decay = decay
+        self.outstanding = dict.fromkeys(hosts, 0)
+        self.ewma = dict.fromkeys(hosts, 0.0)
+        self.fails = dict.fromkeys(hosts, 0)
+        # host -> time its ejection ends
+        self.ejected = {}
+        # ejected hosts with a probe request outstanding
+        self.probing = set()
+        self.lock = threading.Lock()
+        # notified when a request ends, for requests waiting for a probe
+        self.cond = threading.Condition(self.lock)
+
+    def add_host(self, host):
+        with self.lock:
+            if host in self.hosts:
+                return
+            self.hosts.append(host)
+            self.outstanding.setdefault(host, 0)
+            self.ewma.setdefault(host, 0.0)
+            self.fails.setdefault(host, 0)
+            if self.ring is not None:
+                self.ring.add(host)
+
+    def remove_host(self, host):
+        with self.lock:
+            if host in self.hosts:
+                self.hosts.remove(host)
+            if self.ring is not None:
+                self.ring.remove(host)
+
+    def choose(self, exclude=(), path=None, prefer=None):
+        """Returns a healthy host not in exclude for a request for path,
+        or the ejected host whose ejection ends first if none is healthy.
+        Returns None if every host is in exclude or being probed. prefer is
+        returned if it is healthy.
+        """
+        with self.lock:
+            return self._choose(exclude, path, prefer)
+
+    def acquire(self, exclude=(), path=None, prefer=None):
+        """Returns the host for a request like choose and counts the request
+        as outstanding until it is released or failed. Waits up to
+        ejecttime seconds for the result of a probe if only hosts being
+        probed are left.
+        """
+        deadline = time.time() + self.ejecttime
+        with self.lock:
+            while True:
+                host = self._choose(exclude, path, prefer)
+                if host is not None:
+                    break
+                if (not [h for h in self.probing if h not in exclude] or
+                        time.time() >= deadline):
+                    return None
+                self.cond.wait(1)
+            if host in self.ejected:
+                self.probing.add(host)
+            self.outstanding[host] += 1
+            return host
+
+    def release(self, host, resptime=None):
+        """Ends a successful request to host, resptime is its response
+        time in seconds.
+        """
+        with self.lock:
+            self.outstanding[host] -= 1
+            self.fails[host] = 0
+            self.ejected.pop(host, None)
+            self.probing.discard(host)
+            self.cond.notify_all()
+            if resptime is not None:
+                if self.ewma[host]:
+                    self.ewma[host] += self.decay * (resptime - self.ewma[host])
+                else:
+                    self.ewma[host] = resptime
+
+    def fail(self, host):
+        """Ends a failed request to host and ejects it if it failed maxfails
+        requests in a row or was being probed.
+        """
+        with self.lock:
+            self.outstanding[host] -= 1
+            self.fails[host] += 1
+            # requests sent before the host was ejected can still fail
+            if host in self.probing or (host not in self.ejected and
+                                        self.fails[host] >= self.maxfails):
+                self.probing.discard(host)
+                self.ejected[host] = time.time() + self.ejecttime
+                warnings.warn("ejected host %s for %s seconds" % (host, self.ejecttime))
+            self.cond.notify_all()
+
+    def _choose(self, exclude, path, prefer):
+        now = time.time()
+
+        def healthy(h):
+            return h not in exclude and (h not in self.ejected or
+                                         (self.ejected[h] <= now and h not in self.probing))
+
+        if prefer is not None and healthy(prefer):
+            return prefer
+        if self.strategy == 'hash' and path is not None:
+            for h in self.ring.hosts(path):
+                if healthy(h):
+                    return h
+            return self._soonest(exclude)
+        hosts = [h for h in self.hosts if healthy(h)]
+        if not hosts:
+            return self._soonest(exclude)
+        if self.strategy == 'least':
+            return min(hosts, key=lambda h: (self.outstanding[h], random.random()))
+        if self.strategy == 'ewma':
+            # hosts without a response time yet come first
+            return min(hosts, key=lambda h: ((self.outstanding[h] + 1) * self.ewma[h],
+                                             random.random()))
+        if self.strategy == 'p2c' and len(hosts) > 1:
+            a, b = random.sample(hosts, 2)
+            return min(a, b, key=lambda h: (self.outstanding[h], self.ewma[h]))
+        return random.choice(hosts)
+
+    def _soonest(self, exclude):
+        """Returns the host not in exclude and without a probe in flight
+        whose ejection ends first, or None if there is none.
+        """
+        hosts = [h for h in self.hosts if h not in exclude and h not in self.probing]
+        if not hosts:
+            return None
+        return min(hosts, key=lambda h: self.ejected.get(h, 0))
+
+
 class AgentConnection:
-    def __init__(self, hosts=[], port=9999):
+    def __init__(self, hosts=[], port=9999, binary=True, compress=False,
+                 strategy='random', balancer=None, timeout=(5, 60)):
         self.hosts = hosts
         self.port = port
+        # (connect, read) timeouts in seconds, a request that times out
+        # fails over like a connection error
+        self.timeout = timeout
+        self.binary = binary
+        self.compress = compress
+        # hosts are picked for each request, see LoadBalancer
+        self.balancer = balancer or LoadBalancer(hosts, strategy)
+        # host to send requests to while it is healthy
+        self.prefer = None
         self.r = None
         self.resptime = None
         self.ses = None
@@ -37,56 +521,414 @@ class AgentConnection:
             return None
 
 
-    def connect(self):
+    def connect(self, session=None):
         """Sets up requests session and tries to load balance
-        requests across hosts in cluster running diskover storage agent
+        requests across hosts in cluster running diskover storage agent.
+        session is an optional requests session to share with other
+        connections, e.g. between threads
         """
         self.host = self.load_balance()
+        if session is not None:
+            self.ses = session
+            return
         self.ses = requests.Session()
         adapter = requests.adapters.HTTPAdapter(pool_maxsize=100)
         self.ses.mount('http://', adapter)
 
 
-    def load_balance(self):
-        host = random.choice(self.hosts)
-        return host
+    def load_balance(self, exclude=()):
+        return self.balancer.choose(exclude)
+
+
+    def request(self, path, query=None, headers=None, method='get', stream=False,
+                route=None, **kwargs):
+        """Sends a request for path to a host picked by the load balancer
+        and returns the response, or None if it failed on every host.
+        Requests that fail with a connection error or a 5xx status are
+        retried on another host. With stream True the caller has to end
+        the request with self.balancer.release once the response is read.
+        The host is picked for route if given, otherwise for path.
+        Requests time out after self.timeout unless a timeout is given.
+        """
+        if headers is None:
+            headers = self.headers()
+        kwargs.setdefault('timeout', self.timeout)
+        tried = []
+        while True:
+            host = self.balancer.acquire(exclude=tried, path=route or path,
+                                         prefer=self.prefer)
+            if host is None:
+                warnings.warn("no storage agent host available for %s" % path)
+                return None
+            self.host = host
+            try:
+                r = self.ses.request(method, self.url(path, query), headers=headers,
+                                     stream=stream, **kwargs)
+            except requests.exceptions.RequestException as e:
+                warnings.warn("%s: %s" % (host, e))
+                self.balancer.fail(host)
+                tried.append(host)
+                continue
+            if r.status_code >= 500:
+                warnings.warn("%s: %s %s" % (host, r.status_code, r.reason))
+                r.close()
+                self.balancer.fail(host)
+                tried.append(host)
+                continue
+            if not stream:
+                self.balancer.release(host, r.elapsed.total_seconds())
+            self.r = r
+            return r
 
 
-    def listdir(self, path, *args):
-        """Adds subdirs to walk queue
+    def listdir(self, path, stat=False, validators=None, filters=None):
+        """Returns a (path, dirs, files) tuple with the directory listing
+        of path from the storage agent, or None if it could not be listed.
+        With stat True, dirs and files are lists of StatEntry tuples with
+        the stat fields of each entry from the storage node instead of names.
+        validators is an optional dict of path to the ETag of its last
+        listing. If the ETag of path still matches, the agent does not
+        list the directory and dirs and files are None. The dict is
+        updated with the ETag of the new listing, or None if the agent
+        did not send one, so the path stays known for the next walk.
+        filters is an optional dict of filters the agent applies to the
+        listing (see filter_query).
         """
-        pwalk = False
-        if args:  # parallel_walk
-            q = args[0]
-            q_res = args[1]
-            val = args[2]
-            lock = args[3]
-            pwalk = True
         starttime = time.time()
-        url = 'http://%s:%s%s' % (self.host, self.port, path)
-        try:
-            self.r = self.ses.get(url)
-        except requests.exceptions.RequestException as e:
-            warnings.warn(str(e))
+        headers = self.headers()
+        if validators is not None and validators.get(path):
+            headers['If-None-Match'] = validators[path]
+        query = join_query('stat' if stat else None, filter_query(filters))
+        if self.request(path, query, headers) is None:
             return None
         if self.r.status_code == 404:
             warnings.warn("404 No such file or directory")
             return None
+        if self.r.status_code == 400:
+            warnings.warn("400 %s" % self.r.text.strip())
+            return None
         self.resptime = round(time.time() - starttime, 4)
+        if self.r.status_code == 304:  # not modified
+            return path, None, None
+        if validators is not None:
+            validators[path] = self.etag()
+        dirs, nondirs = self.parse_listing(stat)
+        return path, dirs, nondirs
+
+
+    def iter_listdir(self, path, page_size=10000, stat=False, filters=None):
+        """Generator that lists path in pages of up to page_size entries
+        and yields a (path, dirs, files) tuple like listdir for each page,
+        so a directory with millions of entries is read with bounded
+        memory. Every page is a separate request that can be served by a
+        different host. Stops early with a warning if a page could not
+        be listed. Pages of a listing with filters (see filter_query) can
+        have fewer entries.
+        """
+        # raise for invalid filters before the first request
+        fquery = filter_query(filters)
+        cursor = None
+        while True:
+            query = 'limit=%d' % page_size
+            if cursor is not None:
+                query += '&cursor=' + quote(cursor)
+            if stat:
+                query += '&stat'
+            if fquery:
+                query += '&' + fquery
+            if self.request(path, query) is None:
+                return
+            if self.r.status_code != 200:
+                warnings.warn("%s listing page of %s failed" % (self.r.status_code, path))
+                return
+            cursor = self.r.headers.get(CURSOR_HEADER)
+            dirs, nondirs = self.parse_listing(stat)
+            yield path, dirs, nondirs
+            if cursor is None:
+                return
+
+
+    def parse_listing(self, stat):
+        """Returns the (dirs, files) of the listing in the last response."""
+        dirs = []
+        nondirs = []
+        if self.is_binary():
+            for blocktype, value in BinaryDecoder().feed(self.r.content):
+                dirs.extend(value[0])
+                nondirs.extend(value[1])
+            return dirs, nondirs
         dirlist = self.r.text.split("\n")
         if dirlist[-1] == "":
             dirlist.pop()
-        dirs = []
-        nondirs = []
+        if stat:
+            for item in dirlist:
+                entry = parse_stat_line(item)
+                if entry is None:
+                    continue
+                if entry.type == 'd':  # directory
+                    dirs.append(entry)
+                else:  # file
+                    nondirs.append(entry)
+            return dirs, nondirs
         for item in dirlist:
             if item.endswith('/'):  # directory
-                d_name = item.rstrip('/')
-                if pwalk:
-                    add_to_q(q, q_res, val, lock, os.path.join(path, d_name))
-                dirs.append(d_name)
+                dirs.append(item[:-1])
             else:  # file
                 nondirs.append(item)
-        return path, dirs, nondirs
+        return dirs, nondirs
+
+
+    def listdir_many(self, paths, stat=False, filters=None):
+        """Lists all paths in a single batch request and returns a list
+        with a (path, dirs, files) tuple like listdir for each path, in
+        the same order, or None for paths that could not be listed.
+        filters are applied to every listing like in listdir.
+        """
+        if not paths:
+            return []
+        starttime = time.time()
+        body = b'\0'.join([self.encode_path(path) for path in paths])
+        # routed by the first path, the batch is sent to a single host
+        query = join_query('batch&stat' if stat else 'batch', filter_query(filters))
+        if self.request('/', query, method='post', data=body, route=paths[0]) is None:
+            return [None] * len(paths)
+        if self.r.status_code != 200:
+            warnings.warn("%s batch request failed" % self.r.status_code)
+            return [None] * len(paths)
+        self.resptime = round(time.time() - starttime, 4)
+        # records are sent in the order of paths
+        results = []
+        if self.is_binary():
+            for blocktype, value in BinaryDecoder().feed(self.r.content):
+                if blocktype == BLOCK_STATUS:
+                    status = value[0]
+                    dirs = []
+                    nondirs = []
+                elif blocktype == BLOCK_END:
+                    path = paths[len(results)]
+                    results.append((path, dirs, nondirs) if status == 200 else None)
+                else:
+                    dirs.extend(value[0])
+                    nondirs.extend(value[1])
+        else:
+            status = None
+            for line in self.r.content.split(b'\n'):
+                line = line.decode('utf-8', 'replace')
+                if status is None:  # start of record
+                    if not line:
+                        break
+                    status = line.partition(' ')[0]
+                    dirs = []
+                    nondirs = []
+                elif not line:  # end of record
+                    path = paths[len(results)]
+                    results.append((path, dirs, nondirs) if status == '200' else None)
+                    status = None
+                elif stat:
+                    entry = parse_stat_line(line)
+                    if entry is None:
+                        continue
+                    if entry.type == 'd':  # directory
+                        dirs.append(entry)
+                    else:  # file
+                        nondirs.append(entry)
+                elif line.endswith('/'):  # directory
+                    dirs.append(line[:-1])
+                else:  # file
+                    nondirs.append(line)
+        return results + [None] * (len(paths) - len(results))
+
+
+    def walk(self, top, maxdepth=None, stat=False, threads=None, filters=None):
+        """Generator that walks the directory tree under top on the
+        storage agent using a single request and yields (root, dirs, files)
+        tuples as the agent streams them. Subdirectories deeper than
+        maxdepth (top is depth 0) are not walked. With stat True, dirs
+        and files are lists of StatEntry tuples like in listdir. With
+        threads the agent lists directories with that many threads (up
+        to its -w limit) and yields them as they complete, each directory
+        before its subdirectories, instead of in top-down walk order.
+        filters are applied to every listing like in listdir, directories
+        they drop are not walked.
+        """
+        starttime = time.time()
+        query = 'walk'
+        if maxdepth is not None:
+            query += '&maxdepth=%d' % maxdepth
+        if threads is not None:
+            query += '&threads=%d' % threads
+        if stat:
+            query += '&stat'
+        if filters:
+            query += '&' + filter_query(filters)
+        r = self.request(top, query, stream=True)
+        if r is None:
+            return
+        host = self.host
+        if r.status_code != 200:
+            if r.status_code == 404:
+                warnings.warn("404 No such file or directory")
+            else:
+                warnings.warn("%s %s" % (r.status_code, r.text.strip()))
+            r.close()
+            self.balancer.release(host, r.elapsed.total_seconds())
+            return
+        failed = False
+        try:
+            if self.is_binary():
+                records = self._walk_binary()
+            else:
+                records = self._walk_text(stat)
+            for record in records:
+                yield record
+        except requests.exceptions.RequestException as e:
+            warnings.warn(str(e))
+            failed = True
+        finally:
+            r.close()
+            if failed:
+                # e.g. a read timeout from a hung node
+                self.balancer.fail(host)
+            else:
+                self.balancer.release(host, r.elapsed.total_seconds())
+        self.resptime = round(time.time() - starttime, 4)
+
+
+    def du(self, top, maxdepth=None, filters=None):
+        """Generator that yields a DuEntry with the rolled up size, disk
+        usage, file and directory counts and newest mtime of top and
+        every directory under it down to maxdepth (top is depth 0), as
+        computed by the storage agent. Entries are yielded bottom-up,
+        top comes last. Hardlinked files are counted once. With filters
+        (see filter_query) only the entries they keep are counted. Only
+        the connect timeout applies, the agent sends nothing until the
+        first subtree is summed up.
+        """
+        starttime = time.time()
+        query = 'du'
+        if maxdepth is not None:
+            query += '&maxdepth=%d' % maxdepth
+        if filters:
+            query += '&' + filter_query(filters)
+        timeout = self.timeout[0] if isinstance(self.timeout, tuple) else self.timeout
+        r = self.request(top, query, stream=True, timeout=(timeout, None))
+        if r is None:
+            return
+        host = self.host
+        if r.status_code != 200:
+            if r.status_code == 404:
+                warnings.warn("404 No such file or directory")
+            else:
+                warnings.warn("%s %s" % (r.status_code, r.text.strip()))
+            r.close()
+            self.balancer.release(host, r.elapsed.total_seconds())
+            return
+        failed = False
+        try:
+            if self.is_binary():
+                decoder = BinaryDecoder()
+                for chunk in self.r.iter_content(chunk_size=65536):
+                    for blocktype, value in decoder.feed(chunk):
+                        yield value
+            else:
+                for line in self.r.iter_lines(chunk_size=65536):
+                    f = line.decode('utf-8', 'replace').split('\t', 5)
+                    yield DuEntry(f[5], int(f[0]), int(f[1]), int(f[2]),
+                                  int(f[3]), float(f[4]))
+        except requests.exceptions.RequestException as e:
+            warnings.warn(str(e))
+            failed = True
+        finally:
+            r.close()
+            if failed:
+                # e.g. a read timeout from a hung node
+                self.balancer.fail(host)
+            else:
+                self.balancer.release(host, r.elapsed.total_seconds())
+        self.resptime = round(time.time() - starttime, 4)
+
+
+    def _walk_text(self, stat):
+        buf = b''
+        root = None
+        for chunk in self.r.iter_content(chunk_size=65536):
+            buf += chunk
+            lines = buf.split(b'\n')
+            buf = lines.pop()
+            for line in lines:
+                line = line.decode('utf-8', 'replace')
+                if root is None:  # start of record
+                    root = line
+                    dirs = []
+                    nondirs = []
+                elif not line:  # end of record
+                    yield root, dirs, nondirs
+                    root = None
+                elif stat:
+                    entry = parse_stat_line(line)
+                    if entry is None:
+                        continue
+                    if entry.type == 'd':  # directory
+                        dirs.append(entry)
+                    else:  # file
+                        nondirs.append(entry)
+                elif line.endswith('/'):  # directory
+                    dirs.append(line[:-1])
+                else:  # file
+                    nondirs.append(line)
+
+
+    def _walk_binary(self):
+        decoder = BinaryDecoder()
+        for chunk in self.r.iter_content(chunk_size=65536):
+            for blocktype, value in decoder.feed(chunk):
+                if blocktype == BLOCK_ROOT:  # start of record
+                    root = value
+                    dirs = []
+                    nondirs = []
+                elif blocktype == BLOCK_END:  # end of record
+                    yield root, dirs, nondirs
+                else:
+                    dirs.extend(value[0])
+                    nondirs.extend(value[1])
+
+
+    def headers(self):
+        """Returns the request headers, asking for the binary listing
+        format unless the connection uses text and for a gzip compressed
+        response if compress is set
+        """
+        headers = {}
+        if self.binary:
+            headers['Accept'] = BINARY_CONTENT_TYPE
+        if self.compress:
+            headers['Accept-Encoding'] = 'gzip'
+        else:
+            # requests asks for gzip by default
+            headers['Accept-Encoding'] = 'identity'
+        return headers
+
+
+    def is_binary(self):
+        """Returns True if the last response is in the binary listing format,
+        agents that do not support it send text
+        """
+        return self.r.headers.get('content-type', '').startswith(BINARY_CONTENT_TYPE)
+
+
+    def encode_path(self, path):
+        """Returns path as bytes, the inverse of fsname
+        """
+        return fsbytes(path)
+
+
+    def url(self, path, query=None):
+        """Returns the agent url for path on the connected host
+        """
+        url = 'http://%s:%s%s' % (self.host, self.port, quote(self.encode_path(path)))
+        if query:
+            url += '?' + query
+        return url
 
 
     def status_code(self):
@@ -105,6 +947,13 @@ class AgentConnection:
         return self.r.text
 
 
+    def etag(self):
+        """Returns the ETag of the last listing, or None if the agent did
+        not send one (stat listings and recently modified directories)
+        """
+        return self.r.headers.get('etag')
+
+
     def conn_host(self):
         return self.host
 
@@ -117,36 +966,466 @@ class AgentConnection:
         return self.resptime
 
 
-def worker(q, q_res, val, lock, hosts):
-    c = AgentConnection(hosts=hosts)
-    c.connect()
-    while True:
-        item = q.get(True)
-        ret_data = c.listdir(item, q, q_res, val, lock)
-        q_res.put(ret_data)
-        with lock:
-            val.value -= 1
+def children_index(validators):
+    """Returns a dict of directory to the list of its subdirectories
+    from the paths in a validators dict
+    """
+    children = {}
+    for path in validators:
+        children.setdefault(os.path.dirname(path), []).append(path)
+    return children
+
+
+class WalkCheckpoint(object):
+    """On-disk record of the directories of a parallel walk, pending
+    (queued) or done (listed and yielded), in a SQLite database at path
+    so an interrupted walk can continue from its frontier. Rows are
+    written in WAL mode and committed in batches of up to commitsize rows
+    or every commitinterval seconds, a directory that is done and the
+    subdirectories it added are always committed together. Directories
+    in batches that were not committed are listed again on resume.
+    Paths are stored as bytes like in CrawlIndex.
+    """
+
+    def __init__(self, path, top, commitsize=1000, commitinterval=5):
+        self.path = path
+        self.commitsize = commitsize
+        self.commitinterval = commitinterval
+        self.pending = []
+        self.done = []
+        self.lastcommit = time.time()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS walk (key TEXT PRIMARY KEY, value BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dirs (path BLOB PRIMARY KEY, "
+                        "done INTEGER NOT NULL DEFAULT 0)")
+        top = sqlite3.Binary(fsbytes(top))
+        row = self.db.execute("SELECT value FROM walk WHERE key = 'top'").fetchone()
+        if row is not None and bytes(row[0]) != bytes(top):
+            self.db.close()
+            raise ValueError("checkpoint %s is for a walk of %s" % (path, fsname(bytes(row[0]))))
+        if row is not None and self.db.execute(
+                "SELECT 1 FROM dirs WHERE done = 0 LIMIT 1").fetchone() is None:
+            # the walk completed, start over from top
+            self.clear()
+            row = None
+        if row is None:
+            with self.db:
+                self.db.execute("INSERT INTO walk (key, value) VALUES ('top', ?)", (top,))
+                self.db.execute("INSERT INTO dirs (path) VALUES (?)", (top,))
+
+    def frontier(self):
+        """Returns the directories that are pending."""
+        return [fsname(bytes(row[0]))
+                for row in self.db.execute("SELECT path FROM dirs WHERE done = 0")]
+
+    def completed(self):
+        """Generator that yields the directories that are done."""
+        for row in self.db.execute("SELECT path FROM dirs WHERE done = 1"):
+            yield fsname(bytes(row[0]))
+
+    def known(self):
+        """Returns the set of directories that are pending or done."""
+        return set(fsname(bytes(row[0])) for row in self.db.execute("SELECT path FROM dirs"))
+
+    def record(self, path, subdirs):
+        """Records path as done and its subdirs as pending."""
+        self.done.append((sqlite3.Binary(fsbytes(path)),))
+        self.pending.extend([(sqlite3.Binary(fsbytes(d)),) for d in subdirs])
+        if (len(self.done) + len(self.pending) >= self.commitsize or
+                time.time() - self.lastcommit >= self.commitinterval):
+            self.commit()
 
+    def commit(self):
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO dirs (path) VALUES (?)", self.pending)
+            # a dir can be done before its parent recorded it as pending
+            self.db.executemany("INSERT OR REPLACE INTO dirs (path, done) VALUES (?, 1)",
+                                self.done)
+        self.pending = []
+        self.done = []
+        self.lastcommit = time.time()
 
-def add_to_q(q, q_res, val, lock, item):
-    q.put(item)
-    with lock:
-        val.value += 1
+    def clear(self):
+        """Removes all records, the next walk starts from top."""
+        self.pending = []
+        self.done = []
+        with self.db:
+            self.db.execute("DELETE FROM dirs")
+            self.db.execute("DELETE FROM walk")
 
+    def close(self):
+        self.commit()
+        self.db.close()
 
-def parallel_walk(top=unicode("."), workers=40, hosts=[]):
+
+def host_budgets(hosts, workers, weights=None):
+    """Returns a dict of host to the number of workers listing directories
+    on it. workers is the total number of workers, shared by the hosts in
+    proportion to their weights (default 1 each) with at least one per
+    host, or a dict of host to its number of workers.
+    """
+    if isinstance(workers, dict):
+        return collections.OrderedDict((h, workers[h]) for h in hosts if workers.get(h))
+    if weights is None:
+        weights = {}
+    total = float(sum([weights.get(h, 1) for h in hosts]))
+    return collections.OrderedDict(
+        (h, max(1, int(round(workers * weights.get(h, 1) / total)))) for h in hosts)
+
+
+def parallel_walk(top=unicode("."), workers=40, hosts=[], stat=False,
+                  validators=None, prune=False, batchsize=32, resultbatch=16,
+                  strategy='random', balancer=None, weights=None, port=9999,
+                  checkpoint=None, skip_unchanged=False, filters=None, timeout=(5, 60)):
+    """Generator that walks the directory tree under top using worker
+    threads requesting listings from the storage agents over a shared
+    connection pool and yields (root, dirs, files) tuples. Directories
+    that could not be listed are skipped. validators is an optional
+    dict of path to ETag kept between walks (see AgentConnection.listdir).
+    Directories that have not changed since the last walk are yielded
+    with dirs and files None and their subdirectories are taken from
+    validators, or not walked at all with skip_unchanged True. That is
+    only safe if nothing below an unchanged directory can change without
+    changing its ETag, a change in a subdirectory does not change the
+    mtime of its parent on most filesystems. The dict is updated as the
+    walk goes and, with prune True, paths under top that no longer
+    exist are removed from it when the walk completes without errors.
+    Each host has a lane with a queue of directories and its share of
+    the workers (see host_budgets), so a small node is not sent more
+    concurrent requests than it can take. Subdirectories are queued in
+    the lane that listed them, or in the lane of their host on the ring
+    with the hash strategy, and workers of an idle lane steal half of
+    the queue of the busiest lane. Requests of a lane go to its host
+    while it is healthy and fail over with the load balancing strategy
+    (see LoadBalancer), or balancer if given, when it is not.
+    Workers list up to batchsize queued directories in one batch request
+    (see AgentConnection.listdir_many). Batch listings have no ETag, so
+    batching is off when validators is given. Workers hand results over
+    in batches of up to resultbatch. The workers are stopped when the
+    walk completes or the generator is closed. The agents listen on port,
+    requests to them time out after timeout (see AgentConnection).
+    checkpoint is an optional path of a WalkCheckpoint database. A walk
+    with a checkpoint from an earlier walk of top that did not complete
+    starts from the directories that were pending and does not list the
+    ones that were done again. A directory is done once the generator is
+    resumed after yielding it. When the walk completes without errors the
+    checkpoint is cleared, otherwise the directories that could not be
+    listed stay pending for the next walk. A resumed walk does not
+    queue the subdirectories of a directory that are in the checkpoint.
+    filters is an optional dict of filters the agents apply to every
+    listing (see filter_query), directories they drop are not queued.
+    """
     if not hosts:
         warnings.warn("hosts list empty")
         return
-    q = multiprocessing.Queue()
-    q_res = multiprocessing.Queue()
-    q_len = multiprocessing.Value('i', 0)
-    q_lock = multiprocessing.Lock()
+    # raise for invalid filters before the workers start, they are
+    # sent as the query string
+    filters = filter_query(filters)
+    budgets = host_budgets(hosts, workers, weights)
+    ses = requests.Session()
+    # stealing and failover can send every worker to one host
+    adapter = requests.adapters.HTTPAdapter(pool_connections=len(hosts),
+                                            pool_maxsize=sum(budgets.values()))
+    ses.mount('http://', adapter)
+    if balancer is None:
+        balancer = LoadBalancer(hosts, strategy)
+    children = children_index(validators) if validators else {}
+    if validators is not None:
+        batchsize = 1
+    ckpt = WalkCheckpoint(checkpoint, top) if checkpoint else None
+    # dirs of the checkpoint, pending ones are in the frontier already and
+    # done ones are not listed again when their parent is
+    known = ckpt.known() if ckpt is not None else set()
+    lanes = collections.OrderedDict((h, collections.deque()) for h in budgets)
+    # guards the lanes and pending
+    cond = threading.Condition()
+    # bounded so the workers do not get far ahead of the consumer
+    results = Queue.Queue(sum(budgets.values()) * 4)
+    stop = threading.Event()
+    # dirs queued whose results the consumer has not received yet
+    pending = [0]
+
+    def lane_for(path, lane):
+        if balancer.strategy == 'hash':
+            for h in balancer.ring.hosts(path):
+                if h in lanes:
+                    return h
+        return lane
+
+    def enqueue(paths, lane):
+        with cond:
+            # count the dirs before their parent's result is handed
+            # over so the consumer can not see the walk as done
+            pending[0] += len(paths)
+            for path in paths:
+                lanes[lane_for(path, lane)].append(path)
+            cond.notify_all()
+
+    def take(lane, block):
+        """Returns up to batchsize dirs from the lane, or stolen from the
+        busiest lane if it is empty. Returns [] if there are none and
+        block is False, or None once the walk is stopped.
+        """
+        with cond:
+            while not stop.is_set():
+                q = lanes[lane]
+                if q:
+                    return [q.popleft() for i in range(min(batchsize, len(q)))]
+                victim = max(lanes.values(), key=len)
+                if victim:
+                    # steal from the end, the dirs the lane would list last
+                    return [victim.pop() for i in range(min(batchsize, (len(victim) + 1) // 2))]
+                if not block:
+                    return []
+                cond.wait()
+            return None
+
+    def put(batch):
+        while not stop.is_set():
+            try:
+                results.put(batch, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    def worker(lane):
+        c = AgentConnection(hosts=hosts, port=port, balancer=balancer, timeout=timeout)
+        c.connect(ses)
+        c.prefer = lane
+        batch = []
+        while True:
+            items = take(lane, False)
+            if items == []:
+                # hand over the results before waiting for more work
+                if batch:
+                    put(batch)
+                    batch = []
+                items = take(lane, True)
+            if items is None:
+                return
+            try:
+                if len(items) > 1:
+                    listings = c.listdir_many(items, stat, filters)
+                else:
+                    listings = [c.listdir(items[0], stat, validators, filters)]
+            except Exception as e:
+                # e.g. a malformed listing, fail the dirs so the walk
+                # still completes
+                warnings.warn("listing %s failed (%s)" % (items[0], e))
+                if validators is not None:
+                    # the ETag may already be updated, list it again
+                    # next walk
+                    for item in items:
+                        validators.pop(item, None)
+                listings = [None] * len(items)
+            subdirs = []
+            for item, ret_data in zip(items, listings):
+                dirs = None
+                if ret_data is not None:
+                    if ret_data[1] is None:  # not modified
+                        # walk the subdirs seen in the last walk
+                        dirs = [] if skip_unchanged else children.get(item, [])
+                    else:
+                        dirs = [os.path.join(item, d.name if stat else d)
+                                for d in ret_data[1]]
+                    if known:
+                        dirs = [d for d in dirs if d not in known]
+                    subdirs.extend(dirs)
+                batch.append((item, ret_data, dirs))
+            if subdirs:
+                enqueue(subdirs, lane)
+            if len(batch) >= resultbatch:
+                put(batch)
+                batch = []
+
+    threads = []
+    for lane, n in budgets.items():
+        for i in range(n):
+            t = threading.Thread(target=worker, args=(lane,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+    seen = set()
+    if ckpt is not None:
+        frontier = ckpt.frontier()
+        if prune and validators is not None:
+            seen.update(ckpt.completed())
+    else:
+        frontier = [top]
+    failed = False
+    done = not frontier
+    if frontier:
+        enqueue(frontier, next(iter(lanes)))
+    try:
+        while not done:
+            batch = results.get()
+            for item, ret_data, dirs in batch:
+                if ret_data is None:
+                    failed = True
+                    continue
+                if validators is not None:
+                    seen.add(item)
+                    if skip_unchanged and ret_data[1] is None:
+                        # the skipped subtree is still there
+                        stack = list(children.get(item, []))
+                        while stack:
+                            path = stack.pop()
+                            seen.add(path)
+                            stack.extend(children.get(path, []))
+                yield ret_data
+                if ckpt is not None:
+                    ckpt.record(item, dirs)
+            with cond:
+                pending[0] -= len(batch)
+                done = not pending[0]
+
+        if prune and validators is not None and not failed:
+            prefix = os.path.join(top, '')
+            for path in list(validators):
+                if (path == top or path.startswith(prefix)) and path not in seen:
+                    del validators[path]
+        if ckpt is not None and not failed:
+            ckpt.clear()
+    finally:
+        if ckpt is not None:
+            ckpt.close()
+        with cond:
+            stop.set()
+            cond.notify_all()
+        if done:
+            # the workers are idle, wait for them before closing the
+            # connections
+            for t in threads:
+                t.join()
+            ses.close()
+
+
+class CrawlIndex(object):
+    """Local SQLite index of a directory tree for incremental_walk, with
+    the ETag (device, inode, mtime and ctime) of each directory and the
+    names of its subdirectories and files from its last listing. Paths
+    and names are stored as bytes, the names of a directory NUL
+    separated. Changes are committed in batches of up to commitsize
+    directories.
+    """
+
+    def __init__(self, path, commitsize=1000):
+        self.path = path
+        self.commitsize = commitsize
+        self.uncommitted = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dirs (path BLOB PRIMARY KEY, "
+                        "etag TEXT, dirs BLOB, files BLOB)")
+
+    def validators(self, top):
+        """Returns a dict of path to ETag of top and the directories below
+        it, for parallel_walk.
+        """
+        top = fsbytes(top)
+        prefix = os.path.join(top, b'')
+        validators = {}
+        for path, etag in self.db.execute("SELECT path, etag FROM dirs"):
+            path = bytes(path)
+            if path == top or path.startswith(prefix):
+                validators[fsname(path)] = etag
+        return validators
+
+    def listing(self, path):
+        """Returns the (dirs, files) names of path from its last listing as
+        sets of bytes, or None if path is not in the index.
+        """
+        row = self.db.execute("SELECT dirs, files FROM dirs WHERE path = ?",
+                              (sqlite3.Binary(fsbytes(path)),)).fetchone()
+        if row is None:
+            return None
+        return set(split_names(row[0])), set(split_names(row[1]))
+
+    def update(self, path, etag, dirs, files):
+        """Stores the ETag and the dirs and files names (bytes) of path."""
+        self.db.execute("INSERT OR REPLACE INTO dirs (path, etag, dirs, files) VALUES (?, ?, ?, ?)",
+                        (sqlite3.Binary(fsbytes(path)), etag,
+                         sqlite3.Binary(b'\0'.join(dirs)), sqlite3.Binary(b'\0'.join(files))))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commitsize:
+            self.commit()
+
+    def remove_tree(self, path):
+        """Removes path and the directories below it from the index and
+        returns a list of (path, dirs, files) with their names (bytes).
+        """
+        path = fsbytes(path)
+        # every path below path sorts between path/ and path0
+        rows = self.db.execute("SELECT path, dirs, files FROM dirs WHERE path = ? OR "
+                               "(path >= ? AND path < ?)",
+                               (sqlite3.Binary(path), sqlite3.Binary(path + b'/'),
+                                sqlite3.Binary(path + b'0'))).fetchall()
+        self.db.executemany("DELETE FROM dirs WHERE path = ?", [(row[0],) for row in rows])
+        self.uncommitted += len(rows)
+        return [(bytes(row[0]), split_names(row[1]), split_names(row[2])) for row in rows]
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
 
-    pool = multiprocessing.Pool(workers, worker, (q, q_res, q_len, q_lock, hosts))
+def split_names(data):
+    """Returns the list of names in NUL separated bytes data."""
+    data = bytes(data)
+    return data.split(b'\0') if data else []
 
-    add_to_q(q, q_res, q_len, q_lock, top)
 
-    while q_len.value > 0:
-        item = q_res.get(True)
-        yield item
\ No newline at end of file
+def incremental_walk(top=unicode("."), index=None, hosts=[], skip_unchanged=False, **kwargs):
+    """Generator that walks the directory tree under top with
+    parallel_walk and yields a DirDelta for every directory whose
+    entries changed since the last walk with the same index, the path of
+    a CrawlIndex database. Directories whose ETag did not change are not
+    listed again, so a walk costs time in proportion to the directories
+    that changed rather than the size of the tree. With skip_unchanged
+    True the subtrees of unchanged directories are not walked either
+    (see parallel_walk for when that is safe). A directory that is gone
+    is yielded with the names of everything it had removed, as is each
+    directory below it. The first walk yields every directory with all
+    of its entries added. Only names are tracked, changes to the size or
+    times of a file do not change its directory. With stat True the
+    added entries are StatEntry tuples, removed entries are always
+    names. Other keyword arguments are passed to parallel_walk.
+    """
+    stat = kwargs.get('stat')
+    idx = CrawlIndex(index)
+    try:
+        validators = idx.validators(top)
+        for root, dirs, files in parallel_walk(top, hosts=hosts, validators=validators,
+                                               skip_unchanged=skip_unchanged, **kwargs):
+            if dirs is None:  # not modified
+                continue
+            newdirs = dict((fsbytes(d.name if stat else d), d) for d in dirs)
+            newfiles = dict((fsbytes(f.name if stat else f), f) for f in files)
+            old = idx.listing(root)
+            if old is None:
+                olddirs, oldfiles = set(), set()
+            else:
+                olddirs, oldfiles = old
+            removed_dirs = [fsname(d) for d in olddirs.difference(newdirs)]
+            removed_files = [fsname(f) for f in oldfiles.difference(newfiles)]
+            added_dirs = [newdirs[d] for d in newdirs if d not in olddirs]
+            added_files = [newfiles[f] for f in newfiles if f not in oldfiles]
+            idx.update(root, validators.get(root), newdirs, newfiles)
+            removed = []
+            for d in removed_dirs:
+                removed.extend(idx.remove_tree(os.path.join(root, d)))
+            if added_dirs or added_files or removed_dirs or removed_files:
+                yield DirDelta(root, added_dirs, added_files, removed_dirs, removed_files)
+            for path, subdirs, subfiles in removed:
+                yield DirDelta(fsname(path), [], [], [fsname(d) for d in subdirs],
+                               [fsname(f) for f in subfiles])
+    finally:
+        idx.close()
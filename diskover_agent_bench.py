@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""diskover storage agent benchmark
+Generates synthetic directory trees, starts diskover storage agent on
+loopback and measures AgentConnection.listdir and parallel_walk
+throughput and latency. Results are written as JSON so runs of
+different versions can be compared.
+See README.md or https://github.com/shirosaidev/diskover-storage-agent
+for more information.
+
+Copyright (C) Chris Park 2019
+diskover storage agent is released under the Apache 2.0 license.
+See LICENSE for the full license text.
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import platform
+import tempfile
+import threading
+import subprocess
+from optparse import OptionParser
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+import diskover_agent
+
+version = '0.1.1'
+__version__ = version
+
+# remote path the tree is served as by the agent
+REMOTE_ROOT = '/bench'
+# seconds to wait for the agent to start listening
+AGENT_START_TIMEOUT = 30
+SHAPES = ('wide', 'deep', 'balanced')
+
+
+parser = OptionParser(version="diskover storage agent benchmark v % s" % version)
+parser.add_option("-s", "--shapes", default="wide,deep,balanced",
+                    help="Comma separated tree shapes to benchmark, wide (files in one "
+                    "directory), deep (a chain of directories) and balanced "
+                    "(default: wide,deep,balanced)")
+parser.add_option("-f", "--files", metavar="N", default=1000000, type=int,
+                    help="Number of files in the wide tree (default: 1000000)")
+parser.add_option("-d", "--depth", metavar="N", default=10000, type=int,
+                    help="Number of levels of the deep tree, limited by the maximum "
+                    "path length of the system (default: 10000)")
+parser.add_option("-b", "--fanout", metavar="N", default=10, type=int,
+                    help="Subdirectories per directory in the balanced tree (default: 10)")
+parser.add_option("-l", "--levels", metavar="N", default=3, type=int,
+                    help="Levels of subdirectories in the balanced tree (default: 3)")
+parser.add_option("-n", "--dirfiles", metavar="N", default=100, type=int,
+                    help="Files per directory in the balanced tree (default: 100)")
+parser.add_option("-c", "--concurrency", default="1,8,32",
+                    help="Comma separated numbers of concurrent listdir clients "
+                    "and parallel_walk workers (default: 1,8,32)")
+parser.add_option("-r", "--requests", metavar="N", default=50, type=int,
+                    help="Number of listdir requests per concurrency level (default: 50)")
+parser.add_option("-p", "--port", default=9998, type=int,
+                    help="Port to run diskover storage agent on (default: 9998)")
+parser.add_option("-a", "--agentargs", default="",
+                    help="Extra diskover storage agent options, e.g. \"-e events\"")
+parser.add_option("-t", "--text", action="store_true", default=False,
+                    help="Use the text listing format instead of binary for listdir")
+parser.add_option("-w", "--workdir", metavar="DIR",
+                    help="Directory to generate the trees in, trees already there "
+                    "are reused (default: a temp directory removed afterwards)")
+parser.add_option("-o", "--output", metavar="FILE",
+                    help="Write the JSON results to FILE instead of stdout")
+(options, args) = parser.parse_args()
+options = vars(options)
+
+for shape in options['shapes'].split(','):
+	if shape not in SHAPES:
+		parser.error("unknown tree shape %s" % shape)
+
+
+def log(msg):
+    sys.stderr.write("%s\n" % msg)
+    sys.stderr.flush()
+
+
+def max_depth(root):
+    """Returns the deepest chain of one character directories under root
+    that still fits in the maximum path length.
+    """
+    try:
+        pathmax = os.pathconf(root, 'PC_PATH_MAX')
+    except (AttributeError, ValueError, OSError):
+        pathmax = 4096
+    # leave room for file names and the remote path prefix
+    return (pathmax - len(root) - 64) // 2
+
+
+def touch_files(dirpath, count):
+    for i in range(count):
+        os.close(os.open(os.path.join(dirpath, 'f%07d' % i), os.O_CREAT | os.O_WRONLY, 0o644))
+
+
+def remove_tree(path):
+    """Removes the tree at path. The chain of the deep tree is removed
+    from the bottom up a level at a time since shutil.rmtree recurses
+    per level and its paths get too long.
+    """
+    fd = os.open('.', os.O_RDONLY)
+    try:
+        os.chdir(path)
+        levels = 0
+        while os.path.isdir('d'):
+            os.chdir('d')
+            levels += 1
+        for i in range(levels):
+            os.chdir('..')
+            shutil.rmtree('d')
+    finally:
+        os.fchdir(fd)
+        os.close(fd)
+    shutil.rmtree(path)
+
+
+def make_tree(root, shape):
+    """Generates the tree for shape under root unless it was generated
+    before and returns a dict with its description. The tree is the
+    same for the same options.
+    """
+    treedir = os.path.join(root, shape)
+    if shape == 'wide':
+        params = {'files': options['files']}
+    elif shape == 'deep':
+        depth = min(options['depth'], max_depth(treedir))
+        if depth < options['depth']:
+            log("deep tree limited to %d levels by the maximum path length" % depth)
+        params = {'depth': depth}
+    else:
+        params = {'fanout': options['fanout'], 'levels': options['levels'],
+                  'dirfiles': options['dirfiles']}
+    marker = os.path.join(root, '.%s.json' % shape)
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f) == params:
+                log("reusing %s tree" % shape)
+                return dict(params, shape=shape, path=treedir)
+        remove_tree(treedir)
+    log("generating %s tree %s" % (shape, params))
+    os.mkdir(treedir)
+    if shape == 'wide':
+        touch_files(treedir, params['files'])
+    elif shape == 'deep':
+        # create each level relative to the previous one, so it does not
+        # matter how long the full path gets
+        fd = os.open('.', os.O_RDONLY)
+        try:
+            os.chdir(treedir)
+            for i in range(params['depth']):
+                os.mkdir('d')
+                touch_files('d', 1)
+                os.chdir('d')
+        finally:
+            os.fchdir(fd)
+            os.close(fd)
+    else:
+        level = [treedir]
+        for depth in range(params['levels']):
+            nextlevel = []
+            for dirpath in level:
+                touch_files(dirpath, params['dirfiles'])
+                for i in range(params['fanout']):
+                    subdir = os.path.join(dirpath, 'd%03d' % i)
+                    os.mkdir(subdir)
+                    nextlevel.append(subdir)
+            level = nextlevel
+        for dirpath in level:
+            touch_files(dirpath, params['dirfiles'])
+    with open(marker, 'w') as f:
+        json.dump(params, f)
+    return dict(params, shape=shape, path=treedir)
+
+
+def listdir_targets(tree):
+    """Returns the remote paths listed by the listdir benchmark of tree."""
+    remote = REMOTE_ROOT + '/' + tree['shape']
+    if tree['shape'] == 'wide':
+        return [remote]
+    if tree['shape'] == 'deep':
+        # the first levels, deeper paths are too long for a request line
+        return [remote + '/d' * i for i in range(min(tree['depth'], 100))]
+    return [remote] + [remote + '/d%03d' % i for i in range(tree['fanout'])]
+
+
+def percentile(values, pct):
+    """Returns the nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def peak_rss_kb(pid=None):
+    """Returns the peak resident set size in KB of pid or this process,
+    or None if it can not be read.
+    """
+    if pid is not None:
+        try:
+            with open('/proc/%d/status' % pid) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except IOError:
+            return None
+        return None
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on macOS
+        rss //= 1024
+    return rss
+
+
+def start_agent(root):
+    """Starts diskover storage agent serving root as REMOTE_ROOT and
+    waits for it to listen.
+    """
+    agent = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'diskover_storage_agent.py')
+    cmd = [sys.executable, agent, '-l', '127.0.0.1', '-p', str(options['port']),
+           '-r', REMOTE_ROOT, root] + options['agentargs'].split()
+    devnull = open(os.devnull, 'w')
+    proc = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+    devnull.close()
+    deadline = time.time() + AGENT_START_TIMEOUT
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("agent exited with %s" % proc.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', options['port']), 1).close()
+            return proc
+        except socket.error:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("agent did not start listening")
+
+
+def bench_listdir(targets, concurrency):
+    """Runs options['requests'] listdir requests for the targets on
+    concurrency threads and returns the results.
+    """
+    paths = [targets[i % len(targets)] for i in range(options['requests'])]
+    latencies = []
+    counts = {'dirs': 0, 'entries': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def client(paths):
+        c = diskover_agent.AgentConnection(hosts=['127.0.0.1'], port=options['port'],
+                                           binary=not options['text'])
+        c.connect()
+        for path in paths:
+            starttime = time.time()
+            res = c.listdir(path)
+            elapsed = time.time() - starttime
+            with lock:
+                if res is None:
+                    counts['errors'] += 1
+                    continue
+                latencies.append(elapsed)
+                counts['dirs'] += 1
+                counts['entries'] += len(res[1]) + len(res[2])
+
+    threads = [threading.Thread(target=client, args=(paths[i::concurrency],))
+               for i in range(concurrency)]
+    starttime = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - starttime
+    latencies.sort()
+    return {
+        'test': 'listdir',
+        'concurrency': concurrency,
+        'requests': len(paths),
+        'errors': counts['errors'],
+        'seconds': round(elapsed, 4),
+        'dirs_per_sec': round(counts['dirs'] / elapsed, 1),
+        'entries_per_sec': round(counts['entries'] / elapsed, 1),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+    }
+
+
+def bench_walk(tree, workers):
+    """Walks tree with parallel_walk using workers and returns the results."""
+    dirs = 0
+    entries = 0
+    starttime = time.time()
+    last = starttime
+    # time between directories arriving at the consumer
+    gaps = []
+    for root, subdirs, files in diskover_agent.parallel_walk(
+            REMOTE_ROOT + '/' + tree['shape'], workers=workers, hosts=['127.0.0.1'],
+            port=options['port']):
+        now = time.time()
+        gaps.append(now - last)
+        last = now
+        dirs += 1
+        entries += len(subdirs) + len(files)
+    elapsed = time.time() - starttime
+    gaps.sort()
+    return {
+        'test': 'parallel_walk',
+        'concurrency': workers,
+        'dirs': dirs,
+        'seconds': round(elapsed, 4),
+        'dirs_per_sec': round(dirs / elapsed, 1),
+        'entries_per_sec': round(entries / elapsed, 1),
+        'interval_p50': percentile(gaps, 50),
+        'interval_p99': percentile(gaps, 99),
+    }
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stderr=open(os.devnull, 'w'))
+        return out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    # parallel_walk skips and warns about dirs that could not be listed
+    diskover_agent.warnings.simplefilter('ignore')
+    concurrency = [int(c) for c in options['concurrency'].split(',')]
+    workdir = options['workdir']
+    tempdir = None
+    if workdir is None:
+        workdir = tempdir = tempfile.mkdtemp(prefix='diskover_bench_')
+    elif not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    workdir = os.path.realpath(workdir)
+
+    output = {
+        'version': version,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN') if hasattr(os, 'sysconf') else None,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'options': options,
+        'trees': [],
+    }
+    try:
+        for shape in options['shapes'].split(','):
+            tree = make_tree(workdir, shape)
+            proc = start_agent(workdir)
+            try:
+                results = []
+                targets = listdir_targets(tree)
+                for c in concurrency:
+                    log("%s: listdir with %d clients" % (shape, c))
+                    results.append(bench_listdir(targets, c))
+                    log("%s: parallel_walk with %d workers" % (shape, c))
+                    results.append(bench_walk(tree, c))
+                agent_rss = peak_rss_kb(proc.pid)
+            finally:
+                proc.terminate()
+                proc.wait()
+            del tree['path']
+            output['trees'].append({
+                'tree': tree,
+                'results': results,
+                'agent_peak_rss_kb': agent_rss,
+                'client_peak_rss_kb': peak_rss_kb(),
+            })
+    finally:
+        if tempdir is not None:
+            for shape in SHAPES:
+                if os.path.isdir(os.path.join(tempdir, shape)):
+                    remove_tree(os.path.join(tempdir, shape))
+            shutil.rmtree(tempdir)
+
+    data = json.dumps(output, indent=2, sort_keys=True)
+    if options['output']:
+        with open(options['output'], 'w') as f:
+            f.write(data + '\n')
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,7 @@ diskover storage agent is released under the Apache 2.0 license.
 See LICENSE for the full license text.
 """
 
-from scandir import scandir
+from scandir import iter_listdir_typed, listdir_typed, listdir_typed_page, DT_DIR, DT_REG
 import os
 import sys
 import socket
@@ -21,21 +21,107 @@ except ImportError:
 import threading
 import time
 import logging
+import errno
+import collections
+import struct
+import itertools
+import zlib
+import bisect
+import base64
+import json
+import re
+import fnmatch
+import hashlib
+import signal
+import tempfile
+import shutil
+try:
+    import selectors
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # event engine needs Python 3.4+
+    selectors = None
 try:
     from urllib import unquote
 except ImportError:
-    from urllib.parse import unquote
+    from urllib.parse import unquote_to_bytes as unquote
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from urllib.parse import parse_qs
 
 version = '0.1.1'
 __version__ = version
 
 # socket buffer size
-BUFF = 1024
+BUFF = 8192
+# size of chunks sent to client when streaming responses
+CHUNK_SIZE = 65536
+# number of entries encoded at a time
+ENTRY_BATCH = 4096
+# maximum size of request line and headers
+MAX_HEADER_SIZE = 65536
+# maximum size of a request body, e.g. the paths of a batch request
+MAX_BODY_SIZE = 4 * 1024 * 1024
+# timeout for sending a response to a client
+SEND_TIMEOUT = 120
+# seconds since a directory was modified before its listing is cached
+CACHE_MIN_AGE = 2
+# bytes queued for a client before the event engine blocks the handler
+OUTBUF_HIGH = 4 * CHUNK_SIZE
+# path of the metrics output
+METRICS_PATH = b'/metrics'
+# seconds between metrics snapshots of worker processes
+SNAPSHOT_INTERVAL = 1
+# seconds a keep-alive connection has to be idle before it is closed
+# while the server is draining
+DRAIN_IDLE_TIMEOUT = 1
+# seconds a thread of the threads engine serves a keep-alive connection
+# before the connection is closed, after the next response or while it
+# is idle, if other connections are waiting for a thread
+KEEPALIVE_HOLD = 5
+# maximum number of entries of a listing page (limit query parameter)
+MAX_PAGE_ENTRIES = 100000
+# response header with the cursor of the next listing page
+CURSOR_HEADER = 'X-Diskover-Cursor'
+# query parameters of listing filters, see EntryFilter
+FILTER_PARAMS = ('xdir', 'xdirre', 'file', 'xfile', 'minsize', 'maxsize', 'minage', 'maxage')
+# histogram buckets of the metrics output
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+ENTRIES_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
 
 IS_PY3 = sys.version_info >= (3, 0)
 if IS_PY3:
 	unicode = str
 
+# binary listing format, see BinaryFormat
+BINARY_CONTENT_TYPE = 'application/x-diskover-listing'
+BINARY_MAGIC = b'DSKL'
+BINARY_VERSION = 1
+BINARY_FLAG_STAT = 1
+# magic, version, flags
+BINARY_HEADER = struct.Struct('<4sBB')
+# block type, entry count, payload length
+BINARY_BLOCK = struct.Struct('<BII')
+# stat fields of stat listings and their struct format codes
+BINARY_STAT_FIELDS = (
+    ('st_size', 'Q'),
+    ('st_mtime', 'd'),
+    ('st_atime', 'd'),
+    ('st_ctime', 'd'),
+    ('st_ino', 'Q'),
+    ('st_nlink', 'I'),
+    ('st_uid', 'I'),
+    ('st_gid', 'I'),
+)
+BLOCK_ENTRIES = 1
+BLOCK_ROOT = 2
+BLOCK_END = 3
+BLOCK_STATUS = 4
+BLOCK_DU = 5
+# size, disk usage, file count, dir count and newest mtime of a du record
+BINARY_DU = struct.Struct('<QQQQd')
+
 
 parser = OptionParser(version="diskover storage agent v % s" % version)
 parser.add_option("-l", "--listen", default="0.0.0.0", type=str,
@@ -44,20 +130,56 @@ parser.add_option("-p", "--port", metavar="PORT", default=9999, type=int,
 					help="Port for diskover storage agent (default: 9999)")
 parser.add_option("-c", "--maxconnections", default=50, type=int,
 					help="Maximum number of connections (default: 50)")
+parser.add_option("-e", "--engine", default="threads", type="choice", choices=["threads", "events"],
+                    help="Server engine, threads (one thread per connection) or "
+                    "events (event loop, needs Python 3.4+) (default: threads)")
+parser.add_option("-t", "--fsthreads", default=16, type=int,
+                    help="Number of threads doing filesystem work for the events engine (default: 16)")
+parser.add_option("-w", "--walkthreads", metavar="N", default=8, type=int,
+                    help="Maximum number of threads a walk request can list directories "
+                    "with (threads query parameter) (default: 8)")
+parser.add_option("-W", "--workers", metavar="N", default=0, type=int,
+                    help="Number of server processes sharing the port (prefork with SO_REUSEPORT), "
+                    "SIGHUP replaces them and SIGTERM shuts them down gracefully, "
+                    "0 serves from a single process (default: 0)")
+parser.add_option("-k", "--keepalive", metavar="SECONDS", default=15, type=float,
+                    help="Close idle client connections after SECONDS (default: 15)")
+parser.add_option("-z", "--compresslevel", metavar="LEVEL", default=1, type=int,
+                    help="zlib level (1-9) for compressing responses to clients that "
+                    "accept gzip or deflate encoding, 0 to disable (default: 1)")
+parser.add_option("-m", "--compressmin", metavar="BYTES", default=4096, type=int,
+                    help="Minimum response size to compress (default: 4096)")
+parser.add_option("-s", "--cachesize", metavar="MB", default=64, type=int,
+                    help="Size of the directory listing cache in MB, 0 to disable (default: 64)")
+parser.add_option("-n", "--cacheentries", metavar="N", default=10000, type=int,
+                    help="Maximum number of directory listings to cache (default: 10000)")
 parser.add_option("-r", "--replacepath", nargs=2, metavar="PATH PATH",
                     help="Replace paths from remote to local, \
                     example: -r /mnt/share/ /ifs/data/")
-parser.add_option("-v", "--verbose", dest="verbose", action="count",
+parser.add_option("-v", "--verbose", dest="verbose", action="count", default=0,
                     help="Increase verbosity (specify multiple times for more)")
 (options, args) = parser.parse_args()
 options = vars(options)
 
 if not options['replacepath']:
 	parser.error("missing required options, use -h for help")
+if options['engine'] == 'events' and selectors is None:
+	parser.error("events engine requires Python 3.4+")
+if options['workers'] > 0 and not hasattr(os, 'fork'):
+	parser.error("workers require os.fork")
 
 IP = options['listen']
 PORT = options['port']
 MAX_CONNECTIONS = options['maxconnections']
+KEEPALIVE_TIMEOUT = options['keepalive']
+ENGINE = options['engine']
+COMPRESS_LEVEL = options['compresslevel']
+COMPRESS_MIN = options['compressmin']
+CACHE_SIZE = options['cachesize'] * 1024 * 1024
+CACHE_ENTRIES = options['cacheentries']
+FS_THREADS = options['fsthreads']
+WALK_THREADS = max(options['walkthreads'], 1)
+WORKERS = options['workers']
 ROOTDIR_LOCAL = unicode(options['replacepath'][1])
 ROOTDIR_REMOTE = unicode(options['replacepath'][0])
 # remove any trailing slash from paths
@@ -66,89 +188,2279 @@ if ROOTDIR_LOCAL != '/':
 if ROOTDIR_REMOTE != '/':
 	ROOTDIR_REMOTE = ROOTDIR_REMOTE.rstrip(os.path.sep)
 VERBOSE = options['verbose']
+FS_ENCODING = sys.getfilesystemencoding()
+
+
+def fsencode(path):
+    """Encode a unicode path to filesystem bytes, paths are handled as
+    bytes internally so names are sent to the client unaltered.
+    """
+    if isinstance(path, unicode):
+        if IS_PY3:
+            return path.encode(FS_ENCODING, 'surrogateescape')
+        return path.encode(FS_ENCODING)
+    return path
+
+
+def fsdecode(path):
+    """Decode a bytes path for logging."""
+    if isinstance(path, bytes):
+        return path.decode(FS_ENCODING, 'replace')
+    return path
+
+
+ROOTDIR_LOCAL = fsencode(ROOTDIR_LOCAL)
+ROOTDIR_REMOTE = fsencode(ROOTDIR_REMOTE)
+
+
+def translate_path(path):
+    """Translate a remote path sent by the client to the local path."""
+    return path.replace(ROOTDIR_REMOTE, ROOTDIR_LOCAL)
+
+
+def scandir_entries(localpath, with_stat=False, entryfilter=None):
+    """Generator that yields (name, is_dir, st) tuples for the directories
+    and regular files in localpath, symlinks are not followed or listed.
+    st is the lstat result of the entry if with_stat is True, otherwise
+    None. Entries removed before they could be stat'd are skipped, as
+    are entries dropped by entryfilter (see EntryFilter) if given. The
+    directory is read a chunk at a time as entries are consumed, so
+    memory stays flat for huge directories.
+    """
+    for names, types, _ in iter_listdir_typed(localpath):
+        for entry in typed_entries(localpath, names, types, with_stat, entryfilter):
+            yield entry
+
+
+def typed_entries(localpath, names, types, with_stat=False, entryfilter=None):
+    """Generator that yields the (name, is_dir, st) tuples of
+    scandir_entries for the names and DT_* types of entries in
+    localpath.
+    """
+    prefix = os.path.join(localpath, localpath[:0])
+    # files are stat'd for size and age filters even without with_stat
+    stat_files = entryfilter is not None and entryfilter.needs_stat
+    for name, d_type in zip(names, types):
+        if d_type == DT_DIR:
+            is_dir = True
+            if entryfilter is not None and not entryfilter.dir_ok(name):
+                continue
+        elif d_type == DT_REG:
+            is_dir = False
+            if entryfilter is not None and not entryfilter.file_ok(name):
+                continue
+        else:
+            continue
+        st = None
+        if with_stat or (stat_files and not is_dir):
+            try:
+                st = os.lstat(prefix + name)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            if stat_files and not is_dir:
+                if not entryfilter.stat_ok(st):
+                    continue
+                if not with_stat:
+                    st = None
+        yield name, is_dir, st
+
+
+def query_bytes(value):
+    """Returns a query parameter value as filesystem bytes."""
+    if IS_PY3:
+        return fsencode(value)
+    # parse_qs on Python 2 decodes escaped bytes as latin-1
+    return value.encode('latin-1')
+
+
+def glob_regex(patterns):
+    """Returns a compiled bytes regex matching names that match any of
+    the shell glob patterns, or None if there are none.
+    """
+    if not patterns:
+        return None
+    return re.compile(b'|'.join([b'(?:' + query_bytes(fnmatch.translate(p)) + b')'
+                                 for p in patterns]))
+
+
+class EntryFilter(object):
+    """Filter applied to the entries of listings, walks and du from the
+    FILTER_PARAMS query parameters of a request, each can be given more
+    than once. Directories whose name matches an xdir glob or an xdirre
+    regex are dropped, so walks never descend into them. Regular files
+    are kept if their name matches one of the file globs (if any), no
+    xfile glob, their size is between minsize and maxsize bytes and
+    their mtime is between minage and maxage seconds ago. Raises
+    ValueError for an invalid parameter.
+    """
+
+    def __init__(self, params):
+        # canonical form of the filter for ETags and cache keys
+        self.key = tuple((name, tuple(params[name])) for name in FILTER_PARAMS
+                         if name in params)
+        self.xdir = glob_regex(params.get('xdir'))
+        try:
+            self.xdirre = re.compile(b'|'.join([b'(?:' + query_bytes(p) + b')'
+                                                for p in params['xdirre']]))
+        except KeyError:
+            self.xdirre = None
+        except re.error as e:
+            raise ValueError("invalid xdirre regex (%s)" % e)
+        self.file = glob_regex(params.get('file'))
+        self.xfile = glob_regex(params.get('xfile'))
+        try:
+            self.minsize = int(params['minsize'][-1]) if 'minsize' in params else None
+            self.maxsize = int(params['maxsize'][-1]) if 'maxsize' in params else None
+            now = time.time()
+            # mtime bounds from the ages at the time of the request
+            self.maxmtime = now - float(params['minage'][-1]) if 'minage' in params else None
+            self.minmtime = now - float(params['maxage'][-1]) if 'maxage' in params else None
+        except ValueError:
+            raise ValueError("size and age filters must be numbers")
+        self.needs_stat = self.minsize is not None or self.maxsize is not None \
+            or self.maxmtime is not None or self.minmtime is not None
+
+    def dir_ok(self, name):
+        if self.xdir is not None and self.xdir.match(name):
+            return False
+        if self.xdirre is not None and self.xdirre.search(name):
+            return False
+        return True
+
+    def file_ok(self, name):
+        if self.file is not None and not self.file.match(name):
+            return False
+        if self.xfile is not None and self.xfile.match(name):
+            return False
+        return True
+
+    def stat_ok(self, st):
+        if self.minsize is not None and st.st_size < self.minsize:
+            return False
+        if self.maxsize is not None and st.st_size > self.maxsize:
+            return False
+        if self.maxmtime is not None and st.st_mtime > self.maxmtime:
+            return False
+        if self.minmtime is not None and st.st_mtime < self.minmtime:
+            return False
+        return True
+
+    def digest(self):
+        """Returns a short hex digest of the filter for ETags."""
+        data = b'\0'.join([name.encode('ascii') + b'=' + query_bytes(value)
+                           for name, values in self.key for value in values])
+        return hashlib.sha1(data).hexdigest()[:16]
+
+
+def entry_filter(req):
+    """Returns the EntryFilter for the query parameters of req, or None
+    if it has no filter parameters.
+    """
+    for name in FILTER_PARAMS:
+        if name in req.params:
+            return EntryFilter(req.params)
+    return None
+
+
+def format_entry(name, is_dir, st):
+    """Returns the text listing line for an entry. Without stat the line
+    is the name with a trailing / for directories. With stat it is the
+    type (d or f) and the stat fields size, mtime, atime, ctime, inode,
+    nlink, uid and gid separated by tabs, followed by the name.
+    """
+    if st is None:
+        if is_dir:
+            return name + b"/\n"
+        return name + b"\n"
+    return ("%s\t%d\t%r\t%r\t%r\t%d\t%d\t%d\t%d\t" % (
+        'd' if is_dir else 'f', st.st_size, st.st_mtime, st.st_atime,
+        st.st_ctime, st.st_ino, st.st_nlink, st.st_uid, st.st_gid)
+        ).encode('ascii') + name + b"\n"
+
+
+class TextFormat(object):
+    """Newline delimited text listing format, directories have a
+    trailing /. Walk records start with the root path on its own line
+    and end with an empty line, batch records start with the status
+    and the path separated by a space. du records are the totals and
+    the path separated by tabs.
+    """
+    content_type = "text/plain; charset=utf-8"
+    preamble = b""
+    record_end = b"\n"
+
+    def __init__(self, with_stat):
+        self.with_stat = with_stat
+
+    def entries(self, entries):
+        return b"".join([format_entry(*entry) for entry in entries])
+
+    def root(self, path):
+        return path + b"\n"
+
+    def status(self, status, path):
+        return ("%d " % status).encode('ascii') + path + b"\n"
+
+    def du(self, path, totals):
+        return ("%d\t%d\t%d\t%d\t%r\t" % tuple(totals)).encode('ascii') + path + b"\n"
+
+
+class BinaryFormat(object):
+    """Binary listing format, sent to clients that accept
+    BINARY_CONTENT_TYPE. The stream starts with a BINARY_HEADER (magic,
+    version and flags) followed by blocks, each a BINARY_BLOCK header
+    (block type, entry count and payload length) and the payload.
+    Entries are sent in column order in BLOCK_ENTRIES blocks: a type
+    byte (d or f) per entry, the names separated by NUL bytes (which
+    can not appear in a name, any other byte can) and, with the stat
+    flag, an array per stat field (see BINARY_STAT_FIELDS). Walk records
+    start with a BLOCK_ROOT holding the root path and end with a
+    BLOCK_END, batch records start with a BLOCK_STATUS holding the path
+    with the status as the entry count. A du record is a BLOCK_DU with
+    the BINARY_DU totals followed by the path. Both sides encode and
+    decode a block with a few join, split and struct calls instead of
+    per entry string work.
+    """
+    content_type = BINARY_CONTENT_TYPE
+    record_end = BINARY_BLOCK.pack(BLOCK_END, 0, 0)
+
+    def __init__(self, with_stat):
+        self.with_stat = with_stat
+        self.preamble = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION,
+                                           BINARY_FLAG_STAT if with_stat else 0)
+
+    def entries(self, entries):
+        n = len(entries)
+        payload = bytes(bytearray([100 if is_dir else 102 for name, is_dir, st in entries])) \
+                  + b"\0".join([name for name, is_dir, st in entries])
+        if self.with_stat:
+            sts = [st for name, is_dir, st in entries]
+            payload += b"".join([
+                struct.pack('<%d%s' % (n, code), *[getattr(st, field) for st in sts])
+                for field, code in BINARY_STAT_FIELDS])
+        return BINARY_BLOCK.pack(BLOCK_ENTRIES, n, len(payload)) + payload
+
+    def root(self, path):
+        return BINARY_BLOCK.pack(BLOCK_ROOT, 0, len(path)) + path
+
+    def status(self, status, path):
+        return BINARY_BLOCK.pack(BLOCK_STATUS, status, len(path)) + path
+
+    def du(self, path, totals):
+        return BINARY_BLOCK.pack(BLOCK_DU, 1, BINARY_DU.size + len(path)) \
+               + BINARY_DU.pack(*totals) + path
+
+
+def listing_format(req):
+    """Returns the listing format for req, binary if the client accepts
+    it, otherwise text.
+    """
+    with_stat = 'stat' in req.params
+    if BINARY_CONTENT_TYPE in req.headers.get('accept', ''):
+        return BinaryFormat(with_stat)
+    return TextFormat(with_stat)
+
+
+def walk_dirs(localpath, maxdepth=None, with_stat=False, entryfilter=None):
+    """Generator that walks the local directory tree top-down and yields
+    (root, entries) tuples, entries is the list of (name, is_dir, st)
+    tuples from scandir_entries, so symlinks are not followed or listed.
+    Directories deeper than maxdepth (top is depth 0) or dropped by
+    entryfilter are not descended into. Errors listing the top
+    directory are raised, errors listing subdirectories are logged and
+    the directory is skipped.
+    """
+    stack = [(localpath, 0)]
+    while stack:
+        root, depth = stack.pop()
+        try:
+            entries = list(scandir_entries(root, with_stat, entryfilter))
+        except (OSError, IOError) as e:
+            if root == localpath:
+                raise
+            logger.warning("Exception walking %s (%s)" % (fsdecode(root), e))
+            continue
+        yield root, entries
+        if maxdepth is None or depth < maxdepth:
+            # push in reverse so subdirs are walked in listing order
+            for name, is_dir, st in reversed(entries):
+                if is_dir:
+                    stack.append((os.path.join(root, name), depth + 1))
+
+
+def parallel_walk_dirs(localpath, maxdepth=None, with_stat=False, threads=2,
+                       entryfilter=None):
+    """Generator like walk_dirs that lists directories on threads worker
+    threads, for filesystems where every directory listing has a high
+    latency. Records are yielded in the order the listings complete, a
+    directory is always yielded before its subdirectories. The workers
+    are stopped when the generator is closed.
+    """
+    # the top dir is listed here so errors are raised like walk_dirs
+    entries = list(scandir_entries(localpath, with_stat, entryfilter))
+    dirq = Queue.Queue()
+    # bounded so the workers do not get far ahead of a slow client
+    results = Queue.Queue(threads * 4)
+    stop = threading.Event()
+
+    def worker():
+        while True:
+            item = dirq.get()
+            if item is None or stop.is_set():
+                # do not list the dirs still queued once closed
+                return
+            root, depth = item
+            try:
+                result = (root, depth, list(scandir_entries(root, with_stat, entryfilter)))
+            except (OSError, IOError) as e:
+                result = (root, depth, e)
+            while not stop.is_set():
+                try:
+                    results.put(result, timeout=1)
+                    break
+                except Queue.Full:
+                    pass
+
+    workers = []
+    for i in range(threads):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        workers.append(t)
+
+    pending = 0
+    record = (localpath, 0, entries)
+    try:
+        while True:
+            root, depth, entries = record
+            if isinstance(entries, Exception):
+                logger.warning("Exception walking %s (%s)" % (fsdecode(root), entries))
+            else:
+                if maxdepth is None or depth < maxdepth:
+                    # queue the subdirs before yielding so the workers
+                    # list them while the record is sent
+                    for name, is_dir, st in entries:
+                        if is_dir:
+                            dirq.put((os.path.join(root, name), depth + 1))
+                            pending += 1
+                yield root, entries
+            if not pending:
+                break
+            record = results.get()
+            pending -= 1
+    finally:
+        stop.set()
+        for t in workers:
+            dirq.put(None)
+
+
+def du_dirs(localpath, maxdepth=None, entryfilter=None):
+    """Generator that walks the local directory tree and yields (root,
+    totals) tuples bottom-up for the directories down to maxdepth (top
+    is depth 0). totals is a list of the size and disk usage (allocated
+    blocks) of the regular files in the subtree, the number of files,
+    the number of subdirectories and the newest mtime of the directory
+    and everything in it. Files with more than one link are counted
+    once, symlinks are not followed. Only the entries kept by
+    entryfilter are counted if given. Errors listing the top directory
+    are raised, errors listing subdirectories are logged and the
+    subdirectory is counted without its contents.
+    """
+    # (dev, inode) of hardlinked files already counted
+    seen = set()
+
+    def scan(root, st):
+        totals = [0, 0, 0, 0, st.st_mtime]
+        subdirs = []
+        for name, is_dir, est in scandir_entries(root, True, entryfilter):
+            if est.st_mtime > totals[4]:
+                totals[4] = est.st_mtime
+            if is_dir:
+                totals[3] += 1
+                subdirs.append((os.path.join(root, name), est))
+                continue
+            if est.st_nlink > 1:
+                key = (est.st_dev, est.st_ino)
+                if key in seen:
+                    continue
+                seen.add(key)
+            totals[0] += est.st_size
+            totals[1] += getattr(est, 'st_blocks', 0) * 512
+            totals[2] += 1
+        return totals, subdirs
+
+    totals, subdirs = scan(localpath, os.lstat(localpath))
+    # iterative post-order walk, each frame is a directory with the
+    # subdirs left to scan
+    stack = [(localpath, 0, totals, iter(subdirs))]
+    while stack:
+        root, depth, totals, subdirs = stack[-1]
+        for subdir, st in subdirs:
+            try:
+                subtotals, subsubdirs = scan(subdir, st)
+            except (OSError, IOError) as e:
+                logger.warning("Exception walking %s (%s)" % (fsdecode(subdir), e))
+                continue
+            stack.append((subdir, depth + 1, subtotals, iter(subsubdirs)))
+            break
+        else:
+            # all subdirs done, add totals to the parent
+            stack.pop()
+            if stack:
+                parent = stack[-1][2]
+                for i in range(4):
+                    parent[i] += totals[i]
+                if totals[4] > parent[4]:
+                    parent[4] = totals[4]
+            if maxdepth is None or depth <= maxdepth:
+                yield root, totals
+
+
+class ListingCache(object):
+    """Thread safe LRU cache of encoded directory listing responses,
+    keyed by the local path and the response variant (format and
+    content coding) and validated by the directory's stat (see
+    dir_validator). The cache holds at most maxentries listings and
+    maxbytes of response bodies, listings larger than an eighth of
+    maxbytes are not cached.
+    """
+
+    def __init__(self, maxbytes, maxentries):
+        self.maxbytes = maxbytes
+        self.maxentries = maxentries
+        self.maxentrysize = maxbytes // 8
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, validator):
+        """Returns the cached (content_type, content_encoding, body) for
+        key if it is still valid for validator, otherwise None.
+        """
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            if item[0] != validator:
+                # directory changed since the listing was cached
+                self.remove(key)
+                self.misses += 1
+                return None
+            # move to most recently used
+            del self.entries[key]
+            self.entries[key] = item
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, validator, value):
+        """Caches value, a (content_type, content_encoding, body) tuple."""
+        size = len(value[2]) + len(key[0])
+        if size > self.maxentrysize:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (validator, value, size)
+            self.size += size
+            while self.size > self.maxbytes or len(self.entries) > self.maxentries:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        validator, value, size = self.entries.pop(key)
+        self.size -= size
+
+    def stats(self):
+        return "%s entries, %s bytes, %s hits, %s misses, %s evictions" % (
+            len(self.entries), self.size, self.hits, self.misses, self.evictions)
+
+
+def dir_validator(st):
+    """Returns the validator for a directory's stat result, or None if the
+    directory was modified less than CACHE_MIN_AGE seconds ago, since
+    changes within the mtime granularity of the filesystem could be
+    missed.
+    """
+    if time.time() - st.st_mtime < CACHE_MIN_AGE:
+        return None
+    return (st.st_dev, st.st_ino,
+            getattr(st, 'st_mtime_ns', int(st.st_mtime * 1000000000)),
+            getattr(st, 'st_ctime_ns', int(st.st_ctime * 1000000000)))
+
+
+def make_etag(validator, fmt, entryfilter=None):
+    """Returns the ETag for a directory listing from the directory's
+    validator (see dir_validator), the listing format and the filter.
+    It is a weak ETag since the listing bytes depend on the content
+    coding.
+    """
+    dev, ino, mtime, ctime = validator
+    etag = '%x-%x-%x-%x-%s' % (dev, ino, mtime, ctime,
+                               'b' if isinstance(fmt, BinaryFormat) else 't')
+    if entryfilter is not None:
+        etag += '-' + entryfilter.digest()
+    return 'W/"%s"' % etag
+
 
+def etag_matches(req, etag):
+    """Returns True if the If-None-Match header of req matches etag."""
+    header = req.headers.get('if-none-match')
+    if header is None:
+        return False
+    if header.strip() == '*':
+        return True
+    # weak comparison, W/ prefixes are ignored
+    etag = etag[2:]
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
 
-def send_listdir_output(threadnum, path, clientsock, addr):
+
+if CACHE_SIZE:
+    listing_cache = ListingCache(CACHE_SIZE, CACHE_ENTRIES)
+else:
+    listing_cache = None
+
+
+class Histogram(object):
+    """Histogram of observed values with cumulative buckets like
+    Prometheus histograms, not thread safe on its own (see Metrics).
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def state(self):
+        """Returns the counts, sum and count as a list, for a snapshot."""
+        return [list(self.counts), self.sum, self.count]
+
+    def merge(self, state):
+        """Adds the state of another histogram with the same buckets."""
+        counts, total, count = state
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+
+    def lines(self, name, labels=''):
+        """Returns the metrics output lines of the histogram."""
+        sep = ',' if labels else ''
+        lines = []
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, bucket, total))
+        lines.append('%s_bucket{%s%sle="+Inf"} %d' % (name, labels, sep, self.count))
+        labels = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %r' % (name, labels, self.sum))
+        lines.append('%s_count%s %d' % (name, labels, self.count))
+        return lines
+
+
+class Metrics(object):
+    """Thread safe agent metrics, sent in the Prometheus text format to
+    requests for METRICS_PATH: requests by status, the time spent in the
+    scandir, encode and send (including compression) phases of each
+    listing (every directory of walks, du and batches is observed as a
+    listing), entries per listing, bytes sent, busy and queued requests,
+    the time connections or requests wait for a thread and the listing
+    cache counters. With --workers each worker process writes snapshots
+    of its metrics to METRICS_DIR and the output adds up the snapshots
+    of all workers, the gauges only of the workers that are running.
+    """
+    PHASES = ('scandir', 'encode', 'send')
+    CACHE_FIELDS = ('hits', 'misses', 'evictions', 'entries', 'bytes')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = collections.defaultdict(int)
+        self.phases = dict((phase, Histogram(LATENCY_BUCKETS)) for phase in self.PHASES)
+        self.entries = Histogram(ENTRIES_BUCKETS)
+        self.queue_wait = Histogram(LATENCY_BUCKETS)
+        self.bytes_sent = 0
+        # requests being handled and connections or requests waiting
+        # for a thread
+        self.busy = 0
+        self.queued = 0
+        # listing cache counters and gauges, only set on merged metrics
+        self.cache = None
+        self.workers = 0
+
+    def request(self, status):
+        """Counts a response with status, e.g. "200 OK"."""
+        with self.lock:
+            self.requests[status.split(' ', 1)[0]] += 1
+
+    def sent(self, nbytes):
+        with self.lock:
+            self.bytes_sent += nbytes
+
+    def listing(self, timer, numentries=None):
+        """Adds the phase times of a PhaseTimer and the number of entries
+        of a listing.
+        """
+        with self.lock:
+            for phase, elapsed in timer.times.items():
+                self.phases[phase].observe(elapsed)
+            if numentries is not None:
+                self.entries.observe(numentries)
+
+    def enqueue(self):
+        with self.lock:
+            self.queued += 1
+
+    def start(self, queuedtime):
+        """Counts a request or connection taken from the queue at
+        queuedtime as busy.
+        """
+        with self.lock:
+            self.queued -= 1
+            self.busy += 1
+            self.queue_wait.observe(time.time() - queuedtime)
+
+    def finish(self):
+        with self.lock:
+            self.busy -= 1
+
+    def snapshot(self):
+        """Returns the metrics of this process as a dict that can be
+        saved as JSON and added up with merge.
+        """
+        with self.lock:
+            snap = {
+                'pid': os.getpid(),
+                'requests': dict(self.requests),
+                'phases': dict((phase, self.phases[phase].state()) for phase in self.PHASES),
+                'entries': self.entries.state(),
+                'queue_wait': self.queue_wait.state(),
+                'bytes_sent': self.bytes_sent,
+                'busy': self.busy,
+                'queued': self.queued,
+            }
+        if listing_cache is not None:
+            with listing_cache.lock:
+                snap['cache'] = [listing_cache.hits, listing_cache.misses, listing_cache.evictions,
+                                 len(listing_cache.entries), listing_cache.size]
+        return snap
+
+    def merge(self, snap):
+        """Adds the metrics of a snapshot, the gauges only if the process
+        it is from is still running.
+        """
+        running = not snap.get('exited')
+        for status, count in snap['requests'].items():
+            self.requests[status] += count
+        for phase in self.PHASES:
+            self.phases[phase].merge(snap['phases'][phase])
+        self.entries.merge(snap['entries'])
+        self.queue_wait.merge(snap['queue_wait'])
+        self.bytes_sent += snap['bytes_sent']
+        if running:
+            self.busy += snap['busy']
+            self.queued += snap['queued']
+            self.workers += 1
+        if 'cache' in snap:
+            if self.cache is None:
+                self.cache = [0] * len(self.CACHE_FIELDS)
+            # the counters always, entries and bytes only while running
+            n = len(self.CACHE_FIELDS) if running else 3
+            for i in range(n):
+                self.cache[i] += snap['cache'][i]
+
+    def output(self):
+        """Returns the metrics in the Prometheus text format, of all
+        workers with --workers.
+        """
+        total = Metrics()
+        total.merge(self.snapshot())
+        if METRICS_DIR is not None:
+            for snap in read_snapshots(exclude=os.getpid()):
+                total.merge(snap)
+        return total.format()
+
+    def format(self):
+        """Returns merged metrics (see output) in the Prometheus text
+        format.
+        """
+        lines = []
+
+        def metric(name, mtype, helptext, values):
+            lines.append('# HELP diskover_agent_%s %s' % (name, helptext))
+            lines.append('# TYPE diskover_agent_%s %s' % (name, mtype))
+            for labels, value in values:
+                lines.append('diskover_agent_%s%s %s' % (name, labels, value))
+
+        metric('requests_total', 'counter', 'Responses sent by HTTP status.',
+               [('{status="%s"}' % status, count)
+                for status, count in sorted(self.requests.items())])
+        lines.append('# HELP diskover_agent_phase_seconds Time spent per listing in each phase.')
+        lines.append('# TYPE diskover_agent_phase_seconds histogram')
+        for phase in self.PHASES:
+            lines.extend(self.phases[phase].lines('diskover_agent_phase_seconds',
+                                                  'phase="%s"' % phase))
+        lines.append('# HELP diskover_agent_listing_entries Entries per directory listing.')
+        lines.append('# TYPE diskover_agent_listing_entries histogram')
+        lines.extend(self.entries.lines('diskover_agent_listing_entries'))
+        lines.append('# HELP diskover_agent_queue_wait_seconds Time connections (threads '
+                     'engine) or requests (events engine) wait for a thread.')
+        lines.append('# TYPE diskover_agent_queue_wait_seconds histogram')
+        lines.extend(self.queue_wait.lines('diskover_agent_queue_wait_seconds'))
+        metric('sent_bytes_total', 'counter', 'Bytes sent to clients.',
+               [('', self.bytes_sent)])
+        metric('busy_threads', 'gauge', 'Threads serving a connection or request.',
+               [('', self.busy)])
+        metric('queue_depth', 'gauge', 'Connections or requests waiting for a thread.',
+               [('', self.queued)])
+        metric('workers', 'gauge', 'Server processes running.',
+               [('', self.workers)])
+        if self.cache is not None:
+            hits, misses, evictions, entries, size = self.cache
+            metric('cache_hits_total', 'counter', 'Listing cache hits.',
+                   [('', hits)])
+            metric('cache_misses_total', 'counter', 'Listing cache misses.',
+                   [('', misses)])
+            metric('cache_evictions_total', 'counter', 'Listing cache evictions.',
+                   [('', evictions)])
+            metric('cache_entries', 'gauge', 'Listings in the cache.',
+                   [('', entries)])
+            metric('cache_bytes', 'gauge', 'Size of the cached listings.',
+                   [('', size)])
+        return '\n'.join(lines) + '\n'
+
+
+class PhaseTimer(object):
+    """Adds up the time spent in each phase of a listing (see Metrics)."""
+
+    def __init__(self):
+        self.times = dict.fromkeys(Metrics.PHASES, 0.0)
+        self.last = time.time()
+
+    def mark(self, phase):
+        """Adds the time since the last mark to phase."""
+        now = time.time()
+        self.times[phase] += now - self.last
+        self.last = now
+
+
+metrics = Metrics()
+# directory of the metrics snapshots of the worker processes, set by the
+# master process with --workers
+METRICS_DIR = None
+# set on SIGTERM, the server stops accepting connections, responses
+# close their connection and idle connections are closed after
+# DRAIN_IDLE_TIMEOUT
+draining = threading.Event()
+
+
+def snapshot_path(pid):
+    return os.path.join(METRICS_DIR, 'worker-%d.json' % pid)
+
+
+def write_snapshot(snap):
+    """Writes a metrics snapshot to METRICS_DIR, the file is replaced
+    atomically so readers never see a partial snapshot.
+    """
+    path = snapshot_path(snap['pid'])
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snap, f)
+    os.rename(tmp, path)
+
+
+def read_snapshots(exclude=None):
+    """Returns the metrics snapshots in METRICS_DIR, except the one of
+    process exclude.
+    """
+    snaps = []
+    for name in os.listdir(METRICS_DIR):
+        if not (name.startswith('worker-') and name.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snap = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        if snap['pid'] != exclude:
+            snaps.append(snap)
+    return snaps
+
+
+def snapshot_thread_handler():
+    """Writes the metrics snapshot of a worker process every
+    SNAPSHOT_INTERVAL seconds until the server is draining.
+    """
+    while not draining.wait(SNAPSHOT_INTERVAL):
+        try:
+            write_snapshot(metrics.snapshot())
+        except (IOError, OSError) as e:
+            logger.warning("Error writing metrics snapshot (%s)" % e)
+
+
+class RequestError(Exception):
+    """Raised for a malformed client request, status is the HTTP status
+    sent back to the client before closing the connection.
+    """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class Request(object):
+    """A parsed HTTP request from a client."""
+
+    def __init__(self, method, path, params, version, headers, body):
+        self.method = method
+        self.path = path
+        self.params = params
+        self.version = version
+        self.headers = headers
+        self.body = body
+        # EntryFilter from the query parameters, set by handle_request
+        self.entryfilter = None
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = 'close' not in connection
+        else:
+            self.keep_alive = 'keep-alive' in connection
+
+    def param(self, name, default=None):
+        """Returns the first value of query parameter name."""
+        return self.params.get(name, [default])[0]
+
+    def int_param(self, name, default=None):
+        """Returns query parameter name as an int, or default if it is
+        missing or not a number.
+        """
+        try:
+            return int(self.params[name][0])
+        except (KeyError, ValueError):
+            return default
+
+
+def parse_request(buf):
+    """Parses one request from the data received on a connection.
+    Returns a tuple of the Request and the remaining data, e.g.
+    pipelined requests. The Request is None if buf does not hold a
+    complete request yet.
+    """
+    # ignore empty lines before the request line (RFC 7230 3.5)
+    buf = buf.lstrip(b'\r\n')
+    end = buf.find(b'\r\n\r\n')
+    if end == -1:
+        if len(buf) > MAX_HEADER_SIZE:
+            raise RequestError("431 Request Header Fields Too Large", "request header too large")
+        return None, buf
+    head = buf[:end]
+
+    lines = head.split(b'\r\n')
+    # request line e.g. GET /somepath?walk HTTP/1.1
+    requestline = lines[0].split(b' ')
+    if len(requestline) != 3:
+        raise RequestError("400 Bad Request", "malformed request line")
+    method, path, version = requestline
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(b':')
+        if not sep:
+            raise RequestError("400 Bad Request", "malformed request header")
+        headers[name.strip().lower().decode('latin-1')] = value.strip().decode('latin-1')
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        raise RequestError("501 Not Implemented", "chunked request body not supported")
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise RequestError("400 Bad Request", "invalid content-length")
+    if length > MAX_BODY_SIZE:
+        raise RequestError("413 Payload Too Large", "request body too large")
+    if len(buf) < end + 4 + length:
+        return None, buf
+    body = buf[end+4:end+4+length]
+    buf = buf[end+4+length:]
+
+    # split off query string, e.g. /somepath?walk&maxdepth=2
+    path, _, query = path.partition(b'?')
+    params = parse_qs(query.decode('latin-1'), keep_blank_values=True)
+    # decode url to path
+    path = unquote(path)
+    return Request(method.decode('latin-1'), path, params,
+                   version.decode('latin-1'), headers, body), buf
+
+
+def read_request(clientsock, buf):
+    """Reads one request from clientsock. buf is data already received
+    on the connection, e.g. pipelined requests. Returns a tuple of
+    the Request and the remaining data, the Request is None if the
+    client closed the connection.
+    """
+    while True:
+        req, buf = parse_request(buf)
+        if req is not None:
+            return req, buf
+        data = clientsock.recv(BUFF)
+        if not data:
+            return None, buf
+        buf += data
+
+
+class ChunkedWriter(object):
+    """Response body writer that buffers data and sends it to the client
+    socket using HTTP/1.1 chunked transfer encoding, in chunks of about
+    chunksize bytes, so large responses are streamed with flat memory.
+    With chunked False (HTTP/1.0 clients) the data is sent as is and the
+    end of the response is marked by closing the connection. The
+    response header is sent together with the first chunk.
+    With coding gzip or deflate the body is compressed incrementally
+    if it is at least COMPRESS_MIN bytes, each chunk is sync flushed so
+    the client can decompress it as soon as it arrives.
+    """
+
+    def __init__(self, clientsock, header, chunked=True, chunksize=CHUNK_SIZE,
+                 coding=None, capture=0):
+        self.clientsock = clientsock
+        # header lines without the terminating empty line, which is
+        # added once it is known if the body is compressed
+        self.header = header
+        self.chunked = chunked
+        self.chunksize = chunksize
+        self.coding = coding
+        self.compressor = None
+        self.content_encoding = None
+        self.buf = []
+        self.buflen = 0
+        self.bytes_sent = 0
+        # with capture, keep a copy of the (compressed) body of up to
+        # capture bytes for the listing cache
+        self.captured = [] if capture else None
+        self.capturelen = 0
+        self.capturemax = capture
+        if coding is not None:
+            # hold back the header until there is enough data to decide
+            # if compressing is worth it
+            self.chunksize = max(chunksize, COMPRESS_MIN)
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buflen += len(data)
+        if self.buflen >= self.chunksize:
+            self.flush()
+
+    def start_body(self):
+        """Returns the response header and sets up the compressor."""
+        header = self.header
+        self.header = None
+        if self.coding is not None and self.buflen >= COMPRESS_MIN:
+            if self.coding == 'gzip':
+                wbits = 16 + zlib.MAX_WBITS
+            else:
+                wbits = zlib.MAX_WBITS
+            self.compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+            self.content_encoding = self.coding
+            header += ("Content-Encoding: %s\r\n" % self.coding).encode('ascii')
+        self.chunksize = CHUNK_SIZE
+        return header + b'\r\n'
+
+    def flush(self, last=False):
+        data = b''
+        if self.header is not None:
+            data = self.start_body()
+        body = b''
+        if self.buflen:
+            body = b''.join(self.buf)
+            self.buf = []
+            self.buflen = 0
+        if self.compressor is not None:
+            body = self.compressor.compress(body)
+            if last:
+                body += self.compressor.flush()
+            else:
+                body += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if body:
+            if self.captured is not None:
+                self.capturelen += len(body)
+                if self.capturelen > self.capturemax:
+                    self.captured = None
+                else:
+                    self.captured.append(body)
+            if self.chunked:
+                data += ('%x\r\n' % len(body)).encode('ascii') + body + b'\r\n'
+            else:
+                data += body
+        if last and self.chunked:
+            data += b'0\r\n\r\n'
+        if data:
+            self.clientsock.sendall(data)
+            self.bytes_sent += len(data)
+            metrics.sent(len(data))
+
+    def close(self):
+        """Send any buffered data and the terminating zero length chunk."""
+        self.flush(last=True)
+
+
+def connection_header(req):
+    """Returns the Connection response header for req. The connection is
+    closed after the response while the server is draining.
+    """
+    if req is not None and draining.is_set():
+        req.keep_alive = False
+    if req is not None and req.keep_alive:
+        return "Connection: keep-alive\r\n"
+    return "Connection: close\r\n"
+
+
+def accepted_encoding(req):
+    """Returns the content coding to compress the response to req with,
+    gzip or deflate if the client accepts it, or None.
+    """
+    if not COMPRESS_LEVEL:
+        return None
+    accepted = {}
+    for coding in req.headers.get('accept-encoding', '').lower().split(','):
+        coding, _, params = coding.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip()] = q
+    for coding in ('gzip', 'deflate'):
+        if accepted.get(coding, 0) > 0:
+            return coding
+    return None
+
+
+def start_response(clientsock, req, status="200 OK", headers=None,
+                   content_type="text/plain; charset=utf-8", capture=0):
+    """Returns a ChunkedWriter for a streamed response body, the status
+    line and headers are sent with the first chunk. Chunked encoding is
+    used for HTTP/1.1 clients, HTTP/1.0 clients get the connection
+    closed after the response instead. The body is compressed if the
+    client accepts gzip or deflate encoding. With capture the writer
+    keeps a copy of the body of up to capture bytes.
+    """
+    chunked = req.version == 'HTTP/1.1'
+    if not chunked:
+        req.keep_alive = False
+    coding = accepted_encoding(req)
+    metrics.request(status)
+    response = "HTTP/1.1 %s\r\n" % status \
+                +"Content-Type: %s\r\n" % content_type
+    if chunked:
+        response += "Transfer-Encoding: chunked\r\n"
+    response += connection_header(req)
+    if coding is not None:
+        response += "Vary: Accept-Encoding\r\n"
+    if headers:
+        for header in headers:
+            response += "%s: %s\r\n" % header
+    return ChunkedWriter(clientsock, response.encode('utf-8'), chunked,
+                         coding=coding, capture=capture)
+
+
+def send_cached_response(clientsock, req, cached, etag):
+    """Sends a complete response from a listing cache entry."""
+    content_type, content_encoding, body = cached
+    response = "HTTP/1.1 200 OK\r\n" \
+                +"Content-Type: %s\r\n" % content_type \
+                +"Content-Length: %s\r\n" % len(body) \
+                +"ETag: %s\r\n" % etag \
+                +connection_header(req)
+    if accepted_encoding(req) is not None:
+        response += "Vary: Accept-Encoding\r\n"
+    if content_encoding is not None:
+        response += "Content-Encoding: %s\r\n" % content_encoding
+    response += "\r\n"
+    response = response.encode('utf-8') + body
+    clientsock.sendall(response)
+    metrics.request("200 OK")
+    metrics.sent(len(response))
+
+
+def send_not_modified_response(clientsock, req, etag):
+    """Sends a 304 Not Modified response for a listing the client has."""
+    response = "HTTP/1.1 304 Not Modified\r\n" \
+                +"ETag: %s\r\n" % etag \
+                +connection_header(req) \
+                +"\r\n"
+    response = response.encode('utf-8')
+    clientsock.sendall(response)
+    metrics.request("304 Not Modified")
+    metrics.sent(len(response))
+
+
+def send_complete_response(clientsock, req, body, content_type, headers=None):
+    """Sends a complete response with a Content-Length, body is
+    compressed if it is at least COMPRESS_MIN bytes and the client
+    accepts gzip or deflate encoding.
+    """
+    coding = accepted_encoding(req)
+    response = "HTTP/1.1 200 OK\r\n" \
+                +"Content-Type: %s\r\n" % content_type \
+                +connection_header(req)
+    if coding is not None:
+        response += "Vary: Accept-Encoding\r\n"
+        if len(body) >= COMPRESS_MIN:
+            wbits = 16 + zlib.MAX_WBITS if coding == 'gzip' else zlib.MAX_WBITS
+            compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+            body = compressor.compress(body) + compressor.flush()
+            response += "Content-Encoding: %s\r\n" % coding
+    if headers:
+        for header in headers:
+            response += "%s: %s\r\n" % header
+    response += "Content-Length: %s\r\n\r\n" % len(body)
+    response = response.encode('utf-8') + body
+    clientsock.sendall(response)
+    metrics.request("200 OK")
+    metrics.sent(len(response))
+
+
+def send_error_response(clientsock, req, status, message):
+    """Sends a complete error response with message as the body. req is
+    None if the request could not be parsed, the connection is then
+    closed after the response.
+    """
+    body = message.encode('utf-8')
+    response = "HTTP/1.1 %s\r\n" % status \
+                +"Content-Type: text/plain; charset=utf-8\r\n" \
+                +"Content-Length: %s\r\n" % len(body) \
+                +connection_header(req) \
+                +"\r\n"
+    response = response.encode('utf-8') + body
+    clientsock.sendall(response)
+    metrics.request(status)
+    metrics.sent(len(response))
+
+
+def send_listdir_output(threadnum, req, clientsock, addr):
     """This is the send listdir output function.
-    It gets a directory from the listener socket and returns
-    directory listing to client using os.listdir.
+    It gets a directory from the listener socket and streams the
+    directory listing to client in chunks as scandir yields entries.
+    With the stat query parameter the listing includes the stat fields
+    of each entry. The listing is sent in the binary format if the
+    client accepts it (see listing_format). Name listings have an ETag
+    and a 304 Not Modified is sent without listing the directory if the
+    client's If-None-Match matches it, filters without size or age
+    are part of the ETag. Returns True if the complete response was
+    sent.
     """
 
+    path = req.path
     try:
         starttime = time.time()
         # translate path from remote to local
-        localpath = path.replace(ROOTDIR_REMOTE, ROOTDIR_LOCAL)
+        localpath = translate_path(path)
         # run listdir and get output
-        logger.debug("[thread-%s]: Getting listdir %s for %s" % (threadnum, localpath, addr))
-        try:
-            output = ""
-            for entry in scandir(localpath):
-                if entry.is_dir(follow_symlinks=False):
-                    output += entry.name + "/\n"
-                elif entry.is_file(follow_symlinks=False):
-                    output += entry.name + "\n"
-
-            elapsedtime = round(time.time() - starttime, 4)
-            logger.debug("[thread-%s]: Got dirlist %s in %s seconds" % (threadnum, localpath, elapsedtime))
-
-            # send dirlist output to client
-            logger.debug("[thread-%s]: Sending dirlist for %s to %s" % (threadnum, localpath, addr))
-            response = "HTTP/1.1 200 OK\n" \
-                        +"Content-Type: text/plain\n" \
-                        +"\n" \
-                        +output
-            clientsock.send(response.encode('utf-8'))
+        logger.debug("[thread-%s]: Getting listdir %s for %s" % (threadnum, fsdecode(localpath), addr))
+        fmt = listing_format(req)
+        entryfilter = req.entryfilter
+        cachekey = None
+        etag = None
+        if not fmt.with_stat and (entryfilter is None or not entryfilter.needs_stat):
+            # stat listings have no validator, file stat changes do not
+            # change the directory's mtime, neither do size and age
+            # filters
+            try:
+                validator = dir_validator(os.stat(localpath))
+            except (OSError, IOError) as e:
+                logger.warning("[thread-%s]: Exception getting %s (%s)" % (threadnum, fsdecode(path), e))
+                send_error_response(clientsock, req, "404 Not Found",
+                                    "listdir exception: %s (%s)\n" % (fsdecode(path), e))
+                return True
+            if validator is not None:
+                etag = make_etag(validator, fmt, entryfilter)
+                if etag_matches(req, etag):
+                    send_not_modified_response(clientsock, req, etag)
+                    logger.debug("[thread-%s]: Dirlist %s not modified" % (threadnum, fsdecode(localpath)))
+                    return True
+                if listing_cache is not None:
+                    cachekey = (localpath, fmt.content_type, accepted_encoding(req),
+                                entryfilter.key if entryfilter is not None else None)
+                    cached = listing_cache.get(cachekey, validator)
+                    if cached is not None:
+                        send_cached_response(clientsock, req, cached, etag)
+                        logger.debug("[thread-%s]: Sent cached dirlist %s (%s)" %
+                                     (threadnum, fsdecode(localpath), listing_cache.stats()))
+                        return True
+        timer = PhaseTimer()
+        entries = scandir_entries(localpath, fmt.with_stat, entryfilter)
+        try:
+            # get the first entry before sending the header so a
+            # listdir exception is still returned as a 404
+            entry = next(entries, None)
+            timer.mark('scandir')
         except (OSError, IOError) as e:
-            logger.warning("[thread-%s]: Exception getting %s (%s)" % (threadnum, path, e))
-            response = "HTTP/1.1 404 Not Found\n" \
-                        +"Content-Type: text/plain\n" \
-                        +"\n" \
-                        +"listdir exception: %s (%s)\n" % (path, e)
-            clientsock.send(response.encode('utf-8'))
-            pass
+            logger.warning("[thread-%s]: Exception getting %s (%s)" % (threadnum, fsdecode(path), e))
+            send_error_response(clientsock, req, "404 Not Found",
+                                "listdir exception: %s (%s)\n" % (fsdecode(path), e))
+            return True
+
+        # stream dirlist output to client
+        logger.debug("[thread-%s]: Sending dirlist for %s to %s" % (threadnum, fsdecode(localpath), addr))
+        headers = [("ETag", etag)] if etag is not None else None
+        writer = start_response(clientsock, req, headers=headers, content_type=fmt.content_type,
+                                capture=listing_cache.maxentrysize if cachekey else 0)
+        writer.write(fmt.preamble)
+        numentries = 0
+        try:
+            if entry is not None:
+                entries = itertools.chain([entry], entries)
+                while True:
+                    batch = list(itertools.islice(entries, ENTRY_BATCH))
+                    timer.mark('scandir')
+                    if not batch:
+                        break
+                    data = fmt.entries(batch)
+                    timer.mark('encode')
+                    writer.write(data)
+                    timer.mark('send')
+                    numentries += len(batch)
+        except (OSError, IOError) as e:
+            # header already sent, end the response without the last
+            # chunk so the client sees an incomplete listing
+            logger.warning("[thread-%s]: Exception getting %s (%s)" % (threadnum, fsdecode(path), e))
+            writer.flush()
+            return False
+        writer.close()
+        timer.mark('send')
+        metrics.listing(timer, numentries)
+
+        if writer.captured is not None:
+            # only cache the listing if the directory did not change
+            # while it was listed
+            try:
+                if dir_validator(os.stat(localpath)) == validator:
+                    listing_cache.put(cachekey, validator, (fmt.content_type,
+                                      writer.content_encoding, b''.join(writer.captured)))
+            except OSError:
+                pass
+
+        elapsedtime = round(time.time() - starttime, 4)
+        logger.debug("[thread-%s]: Sent dirlist %s (%s entries, %s bytes) in %s seconds" %
+                     (threadnum, fsdecode(localpath), numentries, writer.bytes_sent, elapsedtime))
 
     except socket.error as e:
         logger.error("[thread-%s]: Socket error (%s)" % (threadnum, e))
-        pass
+        return False
+
+    return True
+
+
+def encode_cursor(kind, value):
+    """Returns the opaque cursor of a listing page, kind is o for a
+    directory offset and n for the last name of the previous page.
+    """
+    return base64.urlsafe_b64encode(kind + value).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Returns the (kind, value) of a cursor made by encode_cursor,
+    raises ValueError if it is not valid.
+    """
+    try:
+        # parse_qs returns unicode on Python 2, b64decode needs bytes
+        cursor = cursor.encode('ascii')
+        data = base64.urlsafe_b64decode(cursor + b'=' * (-len(cursor) % 4))
+    except (TypeError, ValueError):
+        # binascii.Error is a ValueError on Python 3 and a TypeError on
+        # Python 2, UnicodeError is a ValueError
+        raise ValueError("invalid cursor")
+    kind, value = data[:1], data[1:]
+    if kind == b'o':
+        try:
+            offset = int(value)
+        except ValueError:
+            raise ValueError("invalid cursor")
+        # directory offsets are signed 64 bit
+        if not 0 <= offset < 2 ** 63:
+            raise ValueError("invalid cursor")
+        return kind, offset
+    if kind == b'n' and value:
+        return kind, value
+    raise ValueError("invalid cursor")
+
+
+def listdir_page(localpath, cursor, limit):
+    """Returns the (names, types, cursor) of the page of at most limit
+    entries of localpath after cursor (None for the first page), the
+    returned cursor is None after the last page. Pages resume at the
+    getdents64 directory offset on Linux, elsewhere the names are
+    sorted and pages resume after the last name of the previous page.
+    """
+    if listdir_typed_page is not None:
+        offset = 0
+        if cursor is not None:
+            kind, offset = decode_cursor(cursor)
+            if kind != b'o':
+                raise ValueError("invalid cursor")
+        names, types, _, offset = listdir_typed_page(localpath, offset, limit)
+        if offset is None:
+            return names, types, None
+        return names, types, encode_cursor(b'o', str(offset).encode('ascii'))
+    after = None
+    if cursor is not None:
+        kind, after = decode_cursor(cursor)
+        if kind != b'n':
+            raise ValueError("invalid cursor")
+    names, types, _ = listdir_typed(localpath)
+    entries = sorted(zip(names, types))
+    if after is not None:
+        entries = entries[bisect.bisect_right(entries, (after, 255)):]
+    if len(entries) <= limit:
+        nextcursor = None
+    else:
+        entries = entries[:limit]
+        nextcursor = encode_cursor(b'n', entries[-1][0])
+    return [e[0] for e in entries], [e[1] for e in entries], nextcursor
+
+
+def send_listdir_page_output(threadnum, req, clientsock, addr):
+    """This is the send listdir page output function.
+    It lists a page of up to the limit query parameter entries of a
+    directory, starting after the cursor query parameter if given, and
+    sends it as a complete response with a Content-Length, so a huge
+    directory is listed in several short requests that can go to
+    different storage nodes. The CURSOR_HEADER response header holds
+    the cursor of the next page and is missing on the last page. A page
+    can have fewer than limit entries, only directories and regular
+    files are listed. Returns True if the complete response was sent.
+    """
+
+    path = req.path
+    limit = req.int_param('limit', 0)
+    cursor = req.param('cursor')
+    if limit <= 0:
+        send_error_response(clientsock, req, "400 Bad Request",
+                            "limit must be a positive number\n")
+        return True
+    limit = min(limit, MAX_PAGE_ENTRIES)
+    try:
+        starttime = time.time()
+        # translate path from remote to local
+        localpath = translate_path(path)
+        logger.debug("[thread-%s]: Getting listdir page %s for %s" % (threadnum, fsdecode(localpath), addr))
+        fmt = listing_format(req)
+        timer = PhaseTimer()
+        try:
+            names, types, nextcursor = listdir_page(localpath, cursor, limit)
+            entries = list(typed_entries(localpath, names, types, fmt.with_stat,
+                                         req.entryfilter))
+        except ValueError as e:
+            send_error_response(clientsock, req, "400 Bad Request", "%s\n" % e)
+            return True
+        except (OSError, IOError) as e:
+            logger.warning("[thread-%s]: Exception getting %s (%s)" % (threadnum, fsdecode(path), e))
+            send_error_response(clientsock, req, "404 Not Found",
+                                "listdir exception: %s (%s)\n" % (fsdecode(path), e))
+            return True
+        finally:
+            timer.mark('scandir')
+        body = fmt.preamble + b''.join([fmt.entries(entries[i:i+ENTRY_BATCH])
+                                        for i in range(0, len(entries), ENTRY_BATCH)])
+        timer.mark('encode')
+        headers = [(CURSOR_HEADER, nextcursor)] if nextcursor is not None else None
+        send_complete_response(clientsock, req, body, fmt.content_type, headers)
+        timer.mark('send')
+        metrics.listing(timer, len(entries))
+
+        elapsedtime = round(time.time() - starttime, 4)
+        logger.debug("[thread-%s]: Sent dirlist page %s (%s entries) in %s seconds" %
+                     (threadnum, fsdecode(localpath), len(entries), elapsedtime))
+
+    except socket.error as e:
+        logger.error("[thread-%s]: Socket error (%s)" % (threadnum, e))
+        return False
+
+    return True
+
+
+def send_walk_output(threadnum, req, clientsock, addr):
+    """This is the send walk output function.
+    It walks the directory tree under path on the storage node and
+    streams a record for every directory to the client over the same
+    connection. Each record is the remote root path on the first line,
+    followed by the directory listing (same format as listdir) and
+    terminated by an empty line. The walk does not descend below the
+    maxdepth query parameter if given and includes stat fields with
+    the stat query parameter. With the threads query parameter the
+    directories are listed by up to WALK_THREADS threads and records
+    are sent in the order the listings complete, each directory before
+    its subdirectories. Returns True if the complete response was sent.
+    """
+
+    path = req.path
+    maxdepth = req.int_param('maxdepth')
+    threads = min(req.int_param('threads', 1), WALK_THREADS)
+    try:
+        starttime = time.time()
+        # translate path from remote to local
+        localpath = translate_path(path)
+        logger.debug("[thread-%s]: Walking %s for %s" % (threadnum, fsdecode(localpath), addr))
+        fmt = listing_format(req)
+        if threads > 1:
+            walker = parallel_walk_dirs(localpath, maxdepth, fmt.with_stat, threads,
+                                        req.entryfilter)
+        else:
+            walker = walk_dirs(localpath, maxdepth, fmt.with_stat, req.entryfilter)
+        timer = PhaseTimer()
+        try:
+            # get the first record before sending the header so a
+            # missing top directory is still returned as a 404
+            record = next(walker)
+            timer.mark('scandir')
+        except (OSError, IOError) as e:
+            logger.warning("[thread-%s]: Exception walking %s (%s)" % (threadnum, fsdecode(path), e))
+            send_error_response(clientsock, req, "404 Not Found",
+                                "walk exception: %s (%s)\n" % (fsdecode(path), e))
+            return True
+
+        writer = start_response(clientsock, req, content_type=fmt.content_type)
+        writer.write(fmt.preamble)
+        numdirs = 0
+        while record is not None:
+            root, entries = record
+            # translate root from local back to remote
+            data = [fmt.root(path + root[len(localpath):])]
+            for i in range(0, len(entries), ENTRY_BATCH):
+                data.append(fmt.entries(entries[i:i+ENTRY_BATCH]))
+            data.append(fmt.record_end)
+            timer.mark('encode')
+            for d in data:
+                writer.write(d)
+            timer.mark('send')
+            # observed per directory like a listing
+            metrics.listing(timer, len(entries))
+            timer = PhaseTimer()
+            numdirs += 1
+            record = next(walker, None)
+            timer.mark('scandir')
+        writer.close()
+
+        elapsedtime = round(time.time() - starttime, 4)
+        logger.debug("[thread-%s]: Walked %s dirs in %s in %s seconds" % (threadnum, numdirs, fsdecode(localpath), elapsedtime))
+
+    except socket.error as e:
+        logger.error("[thread-%s]: Socket error (%s)" % (threadnum, e))
+        # stop the walk threads
+        walker.close()
+        return False
+
+    return True
+
+
+def send_du_output(threadnum, req, clientsock, addr):
+    """This is the send du output function.
+    It walks the directory tree under path on the storage node and
+    streams the rolled up totals (see du_dirs) of every directory down
+    to the maxdepth query parameter, bottom-up, so only one record per
+    directory is sent instead of the metadata of every file. Returns
+    True if the complete response was sent.
+    """
+
+    path = req.path
+    maxdepth = req.int_param('maxdepth')
+    try:
+        starttime = time.time()
+        # translate path from remote to local
+        localpath = translate_path(path)
+        logger.debug("[thread-%s]: Getting du %s for %s" % (threadnum, fsdecode(localpath), addr))
+        fmt = listing_format(req)
+        walker = du_dirs(localpath, maxdepth, req.entryfilter)
+        timer = PhaseTimer()
+        try:
+            # the top directory is listed first, get the first record
+            # before sending the header so a missing top directory is
+            # still returned as a 404
+            record = next(walker)
+            timer.mark('scandir')
+        except (OSError, IOError) as e:
+            logger.warning("[thread-%s]: Exception getting du %s (%s)" % (threadnum, fsdecode(path), e))
+            send_error_response(clientsock, req, "404 Not Found",
+                                "du exception: %s (%s)\n" % (fsdecode(path), e))
+            return True
+
+        writer = start_response(clientsock, req, content_type=fmt.content_type)
+        writer.write(fmt.preamble)
+        numdirs = 0
+        while record is not None:
+            root, totals = record
+            # translate root from local back to remote
+            data = fmt.du(path + root[len(localpath):], totals)
+            timer.mark('encode')
+            writer.write(data)
+            timer.mark('send')
+            # observed per directory like a listing
+            metrics.listing(timer)
+            timer = PhaseTimer()
+            numdirs += 1
+            record = next(walker, None)
+            timer.mark('scandir')
+        writer.close()
+
+        elapsedtime = round(time.time() - starttime, 4)
+        logger.debug("[thread-%s]: Sent du of %s dirs in %s in %s seconds" % (threadnum, numdirs, fsdecode(localpath), elapsedtime))
+
+    except socket.error as e:
+        logger.error("[thread-%s]: Socket error (%s)" % (threadnum, e))
+        return False
+
+    return True
+
+
+def send_batch_output(threadnum, req, clientsock, addr):
+    """This is the send batch output function.
+    It lists every path in the request body (separated by NUL bytes, or
+    by newlines if there are none) and streams a record for each to the
+    client in the order given. A record starts with the HTTP status for
+    the path and the path, followed by the directory listing (same
+    format as listdir) if the status is 200 and terminated by an empty
+    line, so one missing directory does not fail the batch. Returns
+    True if the complete response was sent.
+    """
+
+    if req.method != 'POST':
+        send_error_response(clientsock, req, "405 Method Not Allowed",
+                            "batch requests must be POST\n")
+        return True
+    sep = b'\0' if b'\0' in req.body else b'\n'
+    paths = [path for path in req.body.split(sep) if path]
+    try:
+        starttime = time.time()
+        logger.debug("[thread-%s]: Listing batch of %s dirs for %s" % (threadnum, len(paths), addr))
+        fmt = listing_format(req)
+        writer = start_response(clientsock, req, content_type=fmt.content_type)
+        writer.write(fmt.preamble)
+        numerrors = 0
+        for path in paths:
+            # observed per directory like a listing
+            timer = PhaseTimer()
+            localpath = translate_path(path)
+            try:
+                entries = list(scandir_entries(localpath, fmt.with_stat, req.entryfilter))
+            except (OSError, IOError) as e:
+                logger.warning("[thread-%s]: Exception getting %s (%s)" % (threadnum, fsdecode(path), e))
+                writer.write(fmt.status(404, path))
+                writer.write(fmt.record_end)
+                numerrors += 1
+                continue
+            finally:
+                timer.mark('scandir')
+            data = [fmt.status(200, path)]
+            for i in range(0, len(entries), ENTRY_BATCH):
+                data.append(fmt.entries(entries[i:i+ENTRY_BATCH]))
+            data.append(fmt.record_end)
+            timer.mark('encode')
+            for d in data:
+                writer.write(d)
+            timer.mark('send')
+            metrics.listing(timer, len(entries))
+        writer.close()
+
+        elapsedtime = round(time.time() - starttime, 4)
+        logger.debug("[thread-%s]: Sent batch of %s dirs (%s errors, %s bytes) in %s seconds" %
+                     (threadnum, len(paths), numerrors, writer.bytes_sent, elapsedtime))
+
+    except socket.error as e:
+        logger.error("[thread-%s]: Socket error (%s)" % (threadnum, e))
+        return False
+
+    return True
+
+
+def send_metrics_output(threadnum, req, clientsock, addr):
+    """Sends the agent metrics in the Prometheus text format. Returns
+    True if the complete response was sent.
+    """
+    body = metrics.output().encode('utf-8')
+    response = "HTTP/1.1 200 OK\r\n" \
+                +"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n" \
+                +"Content-Length: %s\r\n" % len(body) \
+                +connection_header(req) \
+                +"\r\n"
+    response = response.encode('utf-8') + body
+    try:
+        clientsock.sendall(response)
+    except socket.error as e:
+        logger.error("[thread-%s]: Socket error (%s)" % (threadnum, e))
+        return False
+    metrics.request("200 OK")
+    metrics.sent(len(response))
+    return True
+
+
+def handle_request(threadnum, req, clientsock, addr):
+    """Dispatches a request to the output function for it. Returns True
+    if the response was sent completely and the connection can be
+    kept open for the next request.
+    """
+    if req.path == METRICS_PATH:
+        logger.debug("[thread-%s]: Got metrics request from %s" % (threadnum, addr))
+        return send_metrics_output(threadnum, req, clientsock, addr)
+    try:
+        req.entryfilter = entry_filter(req)
+    except ValueError as e:
+        send_error_response(clientsock, req, "400 Bad Request", "%s\n" % e)
+        return True
+    if 'batch' in req.params:
+        logger.debug("[thread-%s]: Got batch request from %s" % (threadnum, addr))
+        # list dirs in request body and stream dirlists to client
+        return send_batch_output(threadnum, req, clientsock, addr)
+    if 'du' in req.params:
+        logger.debug("[thread-%s]: Got du request from %s" % (threadnum, addr))
+        # walk tree and stream rolled up dir totals to client
+        return send_du_output(threadnum, req, clientsock, addr)
+    if 'walk' in req.params:
+        logger.debug("[thread-%s]: Got walk request from %s" % (threadnum, addr))
+        # walk tree and stream dirlists to client
+        return send_walk_output(threadnum, req, clientsock, addr)
+    if 'limit' in req.params:
+        logger.debug("[thread-%s]: Got dirlist page request from %s" % (threadnum, addr))
+        # list a page of the dir and send it to client
+        return send_listdir_page_output(threadnum, req, clientsock, addr)
+    logger.debug("[thread-%s]: Got dirlist request from %s" % (threadnum, addr))
+    # get dirlist and send to client
+    return send_listdir_output(threadnum, req, clientsock, addr)
+
+
+def connections_waiting(holdstart):
+    """Returns True if a connection held by a thread since holdstart has
+    had it for KEEPALIVE_HOLD seconds and other connections are waiting
+    for a thread.
+    """
+    return time.time() - holdstart >= KEEPALIVE_HOLD and metrics.queued > 0
+
+
+def wait_for_request(clientsock, holdstart):
+    """Waits for data from an idle client connection. Returns False if
+    it stays idle for KEEPALIVE_TIMEOUT seconds, or DRAIN_IDLE_TIMEOUT
+    seconds once the server is draining, or once other connections are
+    waiting for the thread (see connections_waiting).
+    """
+    start = time.time()
+    while True:
+        timeout = DRAIN_IDLE_TIMEOUT if draining.is_set() else KEEPALIVE_TIMEOUT
+        remaining = start + timeout - time.time()
+        if remaining <= 0 or connections_waiting(holdstart):
+            return False
+        clientsock.settimeout(min(remaining, 1))
+        try:
+            # peek so the data is left for read_request, an empty
+            # result is the client closing the connection
+            clientsock.recv(1, socket.MSG_PEEK)
+            return True
+        except socket.timeout:
+            pass
+
+
+def serve_connection(threadnum, clientsock, addr):
+    """Serves requests from a client connection until the client closes
+    it, asks for it to be closed or it is idle for KEEPALIVE_TIMEOUT
+    seconds. Pipelined requests are served in the order received. A
+    connection held for KEEPALIVE_HOLD seconds is closed after the next
+    response while other connections wait for a thread, so busy
+    keep-alive clients can not keep every thread to themselves.
+    """
+    buf = b''
+    holdstart = time.time()
+    while True:
+        # wait for the next request
+        if not buf and not wait_for_request(clientsock, holdstart):
+            logger.debug("[thread-%s]: %s idle timeout" % (threadnum, addr))
+            return
+        clientsock.settimeout(KEEPALIVE_TIMEOUT)
+        try:
+            req, buf = read_request(clientsock, buf)
+        except socket.timeout:
+            logger.debug("[thread-%s]: %s idle timeout" % (threadnum, addr))
+            return
+        except RequestError as e:
+            logger.warning("[thread-%s]: Bad request from %s (%s)" % (threadnum, addr, e))
+            send_error_response(clientsock, None, e.status, "%s\n" % e)
+            return
+        if req is None:
+            return
+        if connections_waiting(holdstart):
+            # respond with Connection: close and let the client
+            # reconnect behind the waiting connections
+            req.keep_alive = False
+        clientsock.settimeout(SEND_TIMEOUT)
+        if not handle_request(threadnum, req, clientsock, addr):
+            return
+        if not req.keep_alive:
+            return
 
 
 def socket_thread_handler(threadnum, q):
     """This is the socket thread handler function.
-    It processes the dirlist request sent from client.
+    It processes the dirlist requests sent from client.
     """
 
     while True:
+        c = q.get()
+        clientsock, addr, queuedtime = c
+        metrics.start(queuedtime)
         try:
-            c = q.get()
-            clientsock, addr = c
-            data = clientsock.recv(BUFF)
-            data = data.decode('utf-8')
-            if not data:
-                q.task_done()
-                # close connection to client
-                clientsock.close()
-                logger.debug("[thread-%s]: %s closed connection" % (threadnum, addr))
-                continue
-            # grab path from header sent by curl PUT /somepath HTTP/1.1
-            path = data.split('\r\n')[0].split(" ")[1]
-            # decode url to path
-            path = unquote(path)
-            logger.debug("[thread-%s]: Got dirlist request from %s" % (threadnum, addr))
-            # get dirlist and send to client
-            send_listdir_output(threadnum, path, clientsock, addr)
-
+            serve_connection(threadnum, clientsock, addr)
+        except socket.error as e:
+            logger.error("[thread-%s]: Socket error (%s)" % (threadnum, e))
+        except Exception as e:
+            # keep the thread serving connections
+            logger.error("[thread-%s]: Exception handling request from %s (%s)" % (threadnum, addr, e))
+        finally:
+            metrics.finish()
             q.task_done()
             # close connection to client
             clientsock.close()
             logger.debug("[thread-%s]: %s closed connection" % (threadnum, addr))
 
+
+class EventConnection(object):
+    """A client connection served by EventServer. Requests are handled
+    on the executor one at a time in the order received, the handler
+    output functions write to the connection with sendall like a
+    blocking socket. Data that can not be sent right away is queued
+    for the event loop, sendall blocks while more than OUTBUF_HIGH
+    bytes are queued so slow clients do not buffer whole listings.
+    """
+
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.inbuf = b''
+        self.outbuf = collections.deque()
+        self.outlen = 0
+        self.cond = threading.Condition()
+        # a request is being handled on the executor
+        self.busy = False
+        # close once the queued output is sent
+        self.closing = False
+        self.closed = False
+        # events the socket is registered for with the selector
+        self.events = 0
+        self.last_active = time.time()
+
+    def sendall(self, data):
+        """Sends data to the client, called from executor threads."""
+        with self.cond:
+            deadline = time.time() + SEND_TIMEOUT
+            while self.outlen > OUTBUF_HIGH and not self.closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("timed out")
+                self.cond.wait(remaining)
+            if self.closed:
+                raise socket.error(errno.EPIPE, "connection closed")
+            if not self.outbuf:
+                # nothing queued, try sending directly without waiting
+                # for the event loop
+                try:
+                    sent = self.sock.send(data)
+                except socket.error as e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    sent = 0
+                data = data[sent:]
+                if not data:
+                    return
+            self.outbuf.append(data)
+            self.outlen += len(data)
+        self.server.want_write(self)
+
+    def send_queued(self):
+        """Sends queued output, called from the event loop when the
+        socket is writable. Returns True when the queue is empty.
+        """
+        with self.cond:
+            while self.outbuf:
+                data = self.outbuf[0]
+                try:
+                    sent = self.sock.send(data)
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                self.outlen -= sent
+                if sent < len(data):
+                    self.outbuf[0] = data[sent:]
+                    break
+                self.outbuf.popleft()
+            self.cond.notify_all()
+            self.last_active = time.time()
+            return not self.outbuf
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.sock.close()
+
+
+class EventServer(object):
+    """Event driven server engine. A single event loop thread accepts
+    connections and reads requests on non-blocking sockets using the
+    selectors module, so idle keep-alive clients do not tie up threads.
+    Requests, which block in scandir, are handled on a separate
+    executor of FS_THREADS threads. Up to MAX_CONNECTIONS client
+    connections are open at a time.
+    """
+
+    def __init__(self, serversock):
+        self.serversock = serversock
+        self.serversock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.executor = ThreadPoolExecutor(max_workers=FS_THREADS)
+        self.connections = {}
+        self.accepting = False
+        # connections that have output queued or finished a request,
+        # set by executor threads and processed by the event loop
+        self.lock = threading.Lock()
+        self.pending_writes = set()
+        self.pending_done = []
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.woken = False
+        self.draining = False
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+        self.start_accepting()
+
+    def start_accepting(self):
+        if not self.accepting and not self.draining:
+            self.selector.register(self.serversock, selectors.EVENT_READ, None)
+            self.accepting = True
+
+    def stop_accepting(self):
+        if self.accepting:
+            self.selector.unregister(self.serversock)
+            self.accepting = False
+
+    def wakeup(self):
+        with self.lock:
+            if self.woken:
+                return
+            self.woken = True
+        try:
+            self.wakeup_w.send(b'x')
+        except socket.error:
+            pass
+
+    def want_write(self, conn):
+        with self.lock:
+            self.pending_writes.add(conn)
+        self.wakeup()
+
+    def request_done(self, conn, keep_alive):
+        with self.lock:
+            self.pending_done.append((conn, keep_alive))
+        self.wakeup()
+
+    def drain(self):
+        """Stops accepting connections, after taking the ones already
+        waiting. Connections are then closed by the responses or when
+        they are idle for DRAIN_IDLE_TIMEOUT.
+        """
+        self.accept()
+        self.draining = True
+        self.stop_accepting()
+        # with SO_REUSEPORT the kernel keeps queueing connections on the
+        # socket until it is closed
+        self.serversock.close()
+
+    def serve_forever(self):
+        """Runs the event loop until the server is draining and all
+        connections are closed.
+        """
+        last_check = time.time()
+        while True:
+            if draining.is_set():
+                if not self.draining:
+                    self.drain()
+                if not self.connections:
+                    return
+            for key, mask in self.selector.select(timeout=1):
+                if key.fileobj is self.serversock:
+                    self.accept()
+                elif key.fileobj is self.wakeup_r:
+                    self.process_pending()
+                else:
+                    conn = key.data
+                    if mask & selectors.EVENT_WRITE and not conn.closed:
+                        self.write(conn)
+                    if mask & selectors.EVENT_READ and not conn.closed:
+                        self.read(conn)
+            now = time.time()
+            if now - last_check >= 1:
+                self.close_idle(now)
+                last_check = now
+
+    def accept(self):
+        while len(self.connections) < MAX_CONNECTIONS:
+            try:
+                clientsock, addr = self.serversock.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                logger.error("Error accepting connection (%s)" % e)
+                return
+            logger.debug("Got a connection from %s" % str(addr))
+            clientsock.setblocking(False)
+            clientsock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = EventConnection(self, clientsock, addr)
+            self.connections[clientsock.fileno()] = conn
+            self.update_events(conn)
+        # at the connection limit, stop accepting until one is closed
+        self.stop_accepting()
+
+    def read(self, conn):
+        try:
+            data = conn.sock.recv(BUFF)
         except socket.error as e:
-            q.task_done()
-            logger.error("[thread-%s]: Socket error (%s)" % (threadnum, e))
-            # close connection to client
-            clientsock.close()
-            logger.debug("[thread-%s]: %s closed connection" % (threadnum, addr))
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b''
+        if not data:
+            # client closed connection, finish any request in progress
+            if conn.busy or conn.outbuf:
+                conn.closing = True
+                self.update_events(conn)
+            else:
+                self.close(conn)
+            return
+        conn.inbuf += data
+        conn.last_active = time.time()
+        if conn.busy:
+            # stop reading if the client sends more than a few
+            # pipelined requests ahead
+            self.update_events(conn)
+        else:
+            self.next_request(conn)
+
+    def write(self, conn):
+        try:
+            drained = conn.send_queued()
+        except socket.error:
+            self.close(conn)
+            return
+        if drained and conn.closing and not conn.busy:
+            self.close(conn)
+        else:
+            self.update_events(conn)
+
+    def update_events(self, conn):
+        """Registers conn for the events it is waiting for."""
+        events = 0
+        if not conn.closing and (not conn.busy or len(conn.inbuf) < MAX_HEADER_SIZE):
+            events |= selectors.EVENT_READ
+        if conn.outbuf:
+            events |= selectors.EVENT_WRITE
+        if events == conn.events:
+            return
+        if not events:
+            self.selector.unregister(conn.sock)
+        elif not conn.events:
+            self.selector.register(conn.sock, events, conn)
+        else:
+            self.selector.modify(conn.sock, events, conn)
+        conn.events = events
+
+    def next_request(self, conn):
+        """Starts handling the next complete request on conn if any."""
+        try:
+            req, conn.inbuf = parse_request(conn.inbuf)
+        except RequestError as e:
+            logger.warning("[events]: Bad request from %s (%s)" % (conn.addr, e))
+            conn.busy = True
+            conn.closing = True
+            self.update_events(conn)
+            self.executor.submit(self.run_error, conn, e)
+            return
+        if req is None:
+            return
+        conn.busy = True
+        self.update_events(conn)
+        metrics.enqueue()
+        self.executor.submit(self.run_request, conn, req, time.time())
+
+    def run_request(self, conn, req, queuedtime):
+        threadnum = threading.current_thread().name
+        keep_alive = False
+        metrics.start(queuedtime)
+        try:
+            keep_alive = handle_request(threadnum, req, conn, conn.addr) and req.keep_alive
+        except Exception as e:
+            logger.error("[thread-%s]: Exception handling request from %s (%s)" % (threadnum, conn.addr, e))
+        finally:
+            metrics.finish()
+        self.request_done(conn, keep_alive)
+
+    def run_error(self, conn, e):
+        try:
+            send_error_response(conn, None, e.status, "%s\n" % e)
+        except socket.error:
+            pass
+        self.request_done(conn, False)
+
+    def process_pending(self):
+        try:
+            while self.wakeup_r.recv(BUFF):
+                pass
+        except socket.error:
             pass
+        with self.lock:
+            self.woken = False
+            writes = self.pending_writes
+            self.pending_writes = set()
+            done = self.pending_done
+            self.pending_done = []
+        for conn in writes:
+            if not conn.closed:
+                self.write(conn)
+        for conn, keep_alive in done:
+            if conn.closed:
+                continue
+            conn.busy = False
+            conn.last_active = time.time()
+            if not keep_alive:
+                conn.closing = True
+            if conn.closing and not conn.outbuf:
+                self.close(conn)
+                continue
+            self.update_events(conn)
+            if not conn.closing:
+                # serve pipelined request
+                self.next_request(conn)
+
+    def close_idle(self, now):
+        timeout = DRAIN_IDLE_TIMEOUT if self.draining else KEEPALIVE_TIMEOUT
+        for conn in list(self.connections.values()):
+            if not conn.busy and not conn.outbuf and \
+                    now - conn.last_active > timeout:
+                logger.debug("[events]: %s idle timeout" % (conn.addr,))
+                self.close(conn)
+
+    def close(self, conn):
+        if conn.closed:
+            return
+        if conn.events:
+            self.selector.unregister(conn.sock)
+            conn.events = 0
+        del self.connections[conn.sock.fileno()]
+        conn.close()
+        logger.debug("[events]: %s closed connection" % (conn.addr,))
+        if len(self.connections) < MAX_CONNECTIONS:
+            self.start_accepting()
+
+    def shutdown(self):
+        self.stop_accepting()
+        self.executor.shutdown(wait=True)
+        for conn in list(self.connections.values()):
+            self.close(conn)
+
+
+def open_listener(reuseport=False):
+    """Returns a TCP socket listening on IP and PORT. With reuseport the
+    socket is bound with SO_REUSEPORT, so each worker process can listen
+    on its own socket and the kernel spreads connections among them.
+    """
+    serversock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serversock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        serversock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # bind to port
+    serversock.bind((IP, PORT))
+    # start listener
+    serversock.listen(MAX_CONNECTIONS)
+    return serversock
+
+
+def handle_shutdown(signum, frame):
+    """Signal handler that starts a graceful shutdown (see serve)."""
+    if signum == signal.SIGINT:
+        print('\nCtrl-c keyboard interrupt received, shutting down...')
+    draining.set()
+
+
+def serve(serversock):
+    """Serves client connections on serversock with the server engine
+    until draining is set, then stops accepting connections and returns
+    once the connections are done with their requests in progress.
+    """
+    if ENGINE == 'events':
+        server = EventServer(serversock)
+        server.serve_forever()
+        server.shutdown()
+        serversock.close()
+        return
+
+    # Queue for socket threads
+    q = Queue.Queue(maxsize=MAX_CONNECTIONS)
+    # set up the threads and start them
+    for i in range(MAX_CONNECTIONS):
+        # create thread
+        t = threading.Thread(target=socket_thread_handler, args=(i, q,))
+        t.daemon = True
+        t.start()
+
+    def queue_client(clientsock, addr):
+        clientsock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        logger.debug("Got a connection from %s" % str(addr))
+        # add client to list
+        client = (clientsock, addr, time.time())
+        # add task to Queue
+        metrics.enqueue()
+        q.put(client)
+
+    # wake up every second to check for shutdown
+    serversock.settimeout(1)
+    while not draining.is_set():
+        # establish connection
+        try:
+            clientsock, addr = serversock.accept()
+        except socket.timeout:
+            continue
+        except socket.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            logger.error("Error accepting connection (%s)" % e)
+            continue
+        queue_client(clientsock, addr)
+    # take the connections already waiting before closing the socket
+    serversock.setblocking(False)
+    while True:
+        try:
+            clientsock, addr = serversock.accept()
+        except socket.error:
+            break
+        queue_client(clientsock, addr)
+    serversock.close()
+    q.join()
+
+
+def start_worker(serversock):
+    """Forks a worker process that serves connections until SIGTERM and
+    returns its pid. The worker listens on its own SO_REUSEPORT socket,
+    or on serversock if the platform has no SO_REUSEPORT.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 0
+    try:
+        # ctrl-c goes to the whole process group, the master process
+        # shuts the workers down
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, handle_shutdown)
+        if serversock is None:
+            serversock = open_listener(True)
+        write_snapshot(metrics.snapshot())
+        t = threading.Thread(target=snapshot_thread_handler)
+        t.daemon = True
+        t.start()
+        serve(serversock)
+        write_snapshot(metrics.snapshot())
+        logger.debug("Worker %s exiting" % os.getpid())
+    except Exception as e:
+        logger.error("Worker %s failed (%s)" % (os.getpid(), e))
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def mark_exited(pid):
+    """Marks the metrics snapshot of a worker that exited, so only its
+    counters are added up.
+    """
+    try:
+        with open(snapshot_path(pid)) as f:
+            snap = json.load(f)
+        snap['exited'] = True
+        write_snapshot(snap)
+    except (IOError, OSError, ValueError):
+        pass
+
+
+def run_workers(serversock):
+    """Runs WORKERS worker processes and replaces any that exit. On
+    SIGHUP new workers are started and the old ones are shut down
+    gracefully, SIGTERM or ctrl-c shut all of them down gracefully and
+    return once they exited. serversock is only shared with the workers
+    if the platform has no SO_REUSEPORT.
+    """
+    global METRICS_DIR
+    METRICS_DIR = tempfile.mkdtemp(prefix='diskover-agent-')
+    if hasattr(socket, 'SO_REUSEPORT'):
+        serversock.close()
+        serversock = None
+    received = []
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, lambda signum, frame: received.append(signum))
+
+    workers = set([start_worker(serversock) for i in range(WORKERS)])
+    # workers shutting down after a reload or on shutdown
+    retiring = set()
+    stopping = False
+    try:
+        while workers or retiring:
+            time.sleep(0.2)
+            while received:
+                signum = received.pop(0)
+                if stopping:
+                    continue
+                if signum == signal.SIGHUP:
+                    logger.info("Reloading, starting %s new workers" % WORKERS)
+                    old = workers
+                    workers = set([start_worker(serversock) for i in range(WORKERS)])
+                else:
+                    if signum == signal.SIGINT:
+                        print('\nCtrl-c keyboard interrupt received, shutting down...')
+                    logger.info("Shutting down workers")
+                    stopping = True
+                    old = workers
+                    workers = set()
+                for pid in old:
+                    os.kill(pid, signal.SIGTERM)
+                retiring |= old
+            # reap exited workers
+            while True:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except OSError:
+                    break
+                if not pid:
+                    break
+                mark_exited(pid)
+                if pid in retiring:
+                    retiring.discard(pid)
+                elif pid in workers:
+                    workers.discard(pid)
+                    logger.warning("Worker %s exited (status %s), starting a new one" % (pid, status))
+                    workers.add(start_worker(serversock))
+    finally:
+        shutil.rmtree(METRICS_DIR, ignore_errors=True)
 
 
 def main():
@@ -181,26 +2493,7 @@ def main():
     logging.basicConfig(format=logformatter, level=loglevel)
     logger.setLevel(loglevel)
 
-    # Queue for socket threads
-    q = Queue.Queue(maxsize=MAX_CONNECTIONS)
-
-    try:
-        # create TCP socket object
-        serversock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        serversock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # bind to port
-        serversock.bind((IP, PORT))
-        # start listener
-        serversock.listen(MAX_CONNECTIONS)
-
-        # set up the threads and start them
-        for i in range(MAX_CONNECTIONS):
-            # create thread
-            t = threading.Thread(target=socket_thread_handler, args=(i, q,))
-            t.daemon = True
-            t.start()
-        
-        banner = """\033[31m
+    banner = """\033[31m
   __               __
  /\ \  __         /\ \\
  \_\ \/\_\    ____\ \ \/'\\     ___   __  __     __   _ __     //
@@ -216,29 +2509,33 @@ def main():
 	  Support diskover on Patreon or PayPal :)\033[0m
 		""" % version
 
-        print(banner)
-
-        logger.info(" * Listening on http://%s:%s (ctrl-c to shutdown)" % (str(IP), str(PORT)))
-        while True:
-            # establish connection
-            clientsock, addr = serversock.accept()
-            logger.debug("Got a connection from %s" % str(addr))
-            # add client to list
-            client = (clientsock, addr)
-            # add task to Queue
-            q.put(client)
-
+    try:
+        if WORKERS > 0:
+            # the workers open their own sockets, check the port is free
+            # before starting them
+            serversock = open_listener(hasattr(socket, 'SO_REUSEPORT'))
+        else:
+            serversock = open_listener()
     except socket.error as e:
-        serversock.close()
         logger.error("Error opening socket (%s)" % e)
         sys.exit(1)
 
-    except KeyboardInterrupt:
-        print('\nCtrl-c keyboard interrupt received, shutting down...')
-        q.join()
-        serversock.close()
+    print(banner)
+
+    if WORKERS > 0:
+        logger.info(" * Listening on http://%s:%s using %s engine with %s workers (ctrl-c to shutdown)" %
+                    (str(IP), str(PORT), ENGINE, WORKERS))
+        run_workers(serversock)
         sys.exit(0)
 
+    logger.info(" * Listening on http://%s:%s using %s engine (ctrl-c to shutdown)" % (str(IP), str(PORT), ENGINE))
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
+    serve(serversock)
+    if listing_cache is not None:
+        logger.info("Listing cache: %s" % listing_cache.stats())
+    sys.exit(0)
+
 
 if __name__ == "__main__":
     main()
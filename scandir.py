@@ -23,6 +23,7 @@ from os import listdir, lstat, stat, strerror
 from os.path import join, islink
 from stat import S_IFDIR, S_IFLNK, S_IFREG
 import collections
+import os
 import sys
 
 try:
@@ -41,7 +42,7 @@ if _scandir is None and ctypes is None:
                   "or ctypes, using slow generic fallback")
 
 __version__ = '1.9.0'
-__all__ = ['scandir', 'walk']
+__all__ = ['scandir', 'listdir_typed', 'iter_listdir_typed', 'walk']
 
 # Windows FILE_ATTRIBUTE constants for interpreting the
 # FIND_DATA.dwFileAttributes member
@@ -63,6 +64,17 @@ FILE_ATTRIBUTE_SYSTEM = 4
 FILE_ATTRIBUTE_TEMPORARY = 256
 FILE_ATTRIBUTE_VIRTUAL = 65536
 
+# dirent d_type constants, also used for the types returned by
+# listdir_typed(); each is the S_IFMT file type bits shifted right by 12
+DT_UNKNOWN = 0
+DT_FIFO = 1
+DT_CHR = 2
+DT_DIR = 4
+DT_BLK = 6
+DT_REG = 8
+DT_LNK = 10
+DT_SOCK = 12
+
 IS_PY3 = sys.version_info >= (3, 0)
 
 if IS_PY3:
@@ -156,6 +168,9 @@ else:
 
 scandir_c = None
 scandir_python = None
+scandir_getdents = None
+# getdents64 syscall number, set on Linux when ctypes is available
+SYS_getdents64 = None
 
 
 if sys.platform == 'win32':
@@ -450,11 +465,6 @@ elif sys.platform.startswith(('linux', 'darwin', 'sunos5')) or 'bsd' in sys.plat
                     ('d_name', ctypes.c_char * 256),
                 )
 
-        DT_UNKNOWN = 0
-        DT_DIR = 4
-        DT_REG = 8
-        DT_LNK = 10
-
         Dirent_p = ctypes.POINTER(Dirent)
         Dirent_pp = ctypes.POINTER(Dirent_p)
 
@@ -588,6 +598,153 @@ elif sys.platform.startswith(('linux', 'darwin', 'sunos5')) or 'bsd' in sys.plat
                 if closedir(dir_p):
                     raise posix_error(path)
 
+        # Linux fast path: read the directory with the getdents64 syscall
+        # into a large buffer and parse the linux_dirent64 records in bulk,
+        # instead of one readdir_r call and one Dirent() per entry
+        SYS_getdents64 = None
+        if sys.platform.startswith('linux'):
+            import platform
+            import struct
+            import threading
+
+            machine = platform.machine()
+            if ctypes.sizeof(ctypes.c_void_p) == 4:
+                # 32-bit userland on a 64-bit kernel uses the 32-bit table
+                machine = {'x86_64': 'i686', 'aarch64': 'armv7l'}.get(machine, machine)
+            SYS_getdents64 = {
+                'x86_64': 217,
+                'i386': 220,
+                'i686': 220,
+                'aarch64': 61,
+                'riscv64': 61,
+                'armv6l': 217,
+                'armv7l': 217,
+                'ppc64': 202,
+                'ppc64le': 202,
+                's390x': 220,
+            }.get(machine)
+
+        if SYS_getdents64 is not None:
+            from os import open as os_open, close as os_close, lseek, O_RDONLY, SEEK_SET
+
+            GETDENTS_BUFSIZE = 256 * 1024
+
+            # struct linux_dirent64: d_ino, d_off, d_reclen, d_type, d_name;
+            # d_off is skipped, records are padded to 8 bytes
+            dirent64_header = struct.Struct('=Q8xHB')
+            dirent64_header_off = struct.Struct('=QqHB')
+            DIRENT64_NAME_OFFSET = dirent64_header.size
+            DIRENT64_MIN_RECLEN = (DIRENT64_NAME_OFFSET + 2 + 7) & ~7
+
+            getdents64 = libc.syscall
+            getdents64.argtypes = [ctypes.c_long, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t]
+            getdents64.restype = ctypes.c_long
+
+            getdents_flags = (O_RDONLY | getattr(os, 'O_DIRECTORY', 0) |
+                              getattr(os, 'O_CLOEXEC', 0))
+
+            # one buffer per thread, reused for every directory it reads
+            getdents_local = threading.local()
+
+            def getdents_buffer():
+                buf = getattr(getdents_local, 'buf', None)
+                if buf is None:
+                    buf = getdents_local.buf = ctypes.create_string_buffer(GETDENTS_BUFSIZE)
+                return buf
+
+            def getdents_chunks(path):
+                """Yield a (names, types, inodes) tuple of parallel lists for
+                each getdents64 call on path, with '.' and '..' left out.
+                Names are bytes. Each chunk is copied out of the buffer before
+                it is yielded, so the buffer can be reused by nested listings.
+                """
+                fd = os_open(path, getdents_flags)
+                try:
+                    buf = getdents_buffer()
+                    unpack_from = dirent64_header.unpack_from
+                    while True:
+                        nread = getdents64(SYS_getdents64, fd, buf, GETDENTS_BUFSIZE)
+                        if nread < 0:
+                            raise posix_error(path)
+                        if nread == 0:
+                            break
+                        data = ctypes.string_at(buf, nread)
+                        find = data.find
+                        names = []
+                        types = []
+                        inodes = []
+                        pos = 0
+                        while pos < nread:
+                            d_ino, d_reclen, d_type = unpack_from(data, pos)
+                            start = pos + DIRENT64_NAME_OFFSET
+                            pos += d_reclen
+                            name = data[start:find(b'\0', start, pos)]
+                            # '.' and '..' always fit in the smallest record
+                            if d_reclen == DIRENT64_MIN_RECLEN and name in (b'.', b'..'):
+                                continue
+                            names.append(name)
+                            types.append(d_type)
+                            inodes.append(d_ino)
+                        yield names, types, inodes
+                finally:
+                    os_close(fd)
+
+            def scandir_getdents(path=unicode('.')):
+                """Like os.listdir(), but yield DirEntry objects instead of returning
+                a list of names. Linux only, reads the directory with getdents64.
+                """
+                is_bytes = isinstance(path, bytes)
+                for names, types, inodes in getdents_chunks(path):
+                    for name, d_type, d_ino in zip(names, types, inodes):
+                        if not is_bytes:
+                            name = name.decode(file_system_encoding)
+                        yield PosixDirEntry(path, name, d_type, d_ino)
+
+            def getdents_page(path, offset, limit):
+                """Read up to limit entries of path starting at directory
+                offset (a d_off cookie, 0 is the start) and return a
+                (names, types, inodes, offset) tuple, offset is the d_off
+                of the last entry returned or None if there are no more
+                entries. The read size is bounded by limit, so small pages
+                do not read the whole buffer.
+                """
+                fd = os_open(path, getdents_flags)
+                try:
+                    if offset:
+                        lseek(fd, offset, SEEK_SET)
+                    buf = getdents_buffer()
+                    # room for limit + 1 entries with names of ~40 bytes,
+                    # the read is repeated if they are longer
+                    size = min(GETDENTS_BUFSIZE, max(4096, (limit + 1) * 64))
+                    unpack_from = dirent64_header_off.unpack_from
+                    names = []
+                    types = []
+                    inodes = []
+                    while True:
+                        nread = getdents64(SYS_getdents64, fd, buf, size)
+                        if nread < 0:
+                            raise posix_error(path)
+                        if nread == 0:
+                            return names, types, inodes, None
+                        data = ctypes.string_at(buf, nread)
+                        pos = 0
+                        while pos < nread:
+                            d_ino, d_off, d_reclen, d_type = unpack_from(data, pos)
+                            start = pos + DIRENT64_NAME_OFFSET
+                            pos += d_reclen
+                            name = data[start:data.find(b'\0', start, pos)]
+                            if d_reclen == DIRENT64_MIN_RECLEN and name in (b'.', b'..'):
+                                offset = d_off
+                                continue
+                            if len(names) == limit:
+                                return names, types, inodes, offset
+                            names.append(name)
+                            types.append(d_type)
+                            inodes.append(d_ino)
+                            offset = d_off
+                finally:
+                    os_close(fd)
+
     if _scandir is not None:
         scandir_c = _scandir.scandir
         DirEntry_c = _scandir.DirEntry
@@ -595,7 +752,10 @@ elif sys.platform.startswith(('linux', 'darwin', 'sunos5')) or 'bsd' in sys.plat
     if _scandir is not None:
         scandir = scandir_c
         DirEntry = DirEntry_c
-    elif ctypes is not None:
+    elif ctypes is not None and have_dirent_d_type and SYS_getdents64 is not None:
+        scandir = scandir_getdents
+        DirEntry = PosixDirEntry
+    elif ctypes is not None and have_dirent_d_type:
         scandir = scandir_python
         DirEntry = PosixDirEntry
     else:
@@ -609,6 +769,109 @@ else:
     DirEntry = GenericDirEntry
 
 
+def _resolve_types(path, names, types, inodes):
+    """lstat the entries whose type is DT_UNKNOWN and fill in their type,
+    dropping entries that were removed in the meantime.
+    """
+    if DT_UNKNOWN not in types:
+        return names, types, inodes
+    keep = []
+    for i, d_type in enumerate(types):
+        if d_type == DT_UNKNOWN:
+            try:
+                st = lstat(join(path, names[i]))
+            except OSError as e:
+                if e.errno != ENOENT:
+                    raise
+                continue
+            types[i] = (st.st_mode & 0o170000) >> 12
+        keep.append(i)
+    return ([names[i] for i in keep], [types[i] for i in keep],
+            [inodes[i] for i in keep])
+
+
+def _iter_listdir_typed_scandir(path=unicode('.'), chunksize=1024):
+    """iter_listdir_typed() built on scandir(), used where the getdents64
+    reader isn't available. Chunks have up to chunksize entries.
+    """
+    names = []
+    types = []
+    inodes = []
+    for entry in scandir(path):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                d_type = DT_DIR
+            elif entry.is_file(follow_symlinks=False):
+                d_type = DT_REG
+            elif entry.is_symlink():
+                d_type = DT_LNK
+            else:
+                d_type = (entry.stat(follow_symlinks=False).st_mode & 0o170000) >> 12
+            inode = entry.inode()
+        except OSError as e:
+            if e.errno != ENOENT:
+                raise
+            continue
+        names.append(entry.name)
+        types.append(d_type)
+        inodes.append(inode)
+        if len(names) >= chunksize:
+            yield names, types, inodes
+            names = []
+            types = []
+            inodes = []
+    if names:
+        yield names, types, inodes
+
+
+# the getdents64 reader is used for typed listings and pages whenever it
+# is available, even if scandir() is the _scandir C extension
+if SYS_getdents64 is not None:
+    def iter_listdir_typed(path=unicode('.')):
+        """Like listdir_typed(), but yield a (names, types, inodes) tuple
+        of parallel lists for each getdents64 call as the directory is
+        read, so a huge directory is never held in memory at once.
+        DT_UNKNOWN entries are resolved with lstat per chunk.
+        """
+        is_bytes = isinstance(path, bytes)
+        for names, types, inodes in getdents_chunks(path):
+            if not is_bytes:
+                names = [name.decode(file_system_encoding) for name in names]
+            yield _resolve_types(path, names, types, inodes)
+
+    def listdir_typed_page(path, offset=0, limit=1000):
+        """Like listdir_typed(), but return at most limit entries starting
+        at directory offset as a (names, types, inodes, offset) tuple, the
+        returned offset is where the next page starts or None after the
+        last page. Offsets are getdents64 d_off cookies, entries added or
+        removed between pages may be missed, all others are returned once.
+        Linux only, None on other platforms.
+        """
+        names, types, inodes, offset = getdents_page(path, offset, limit)
+        if not isinstance(path, bytes):
+            names = [name.decode(file_system_encoding) for name in names]
+        return _resolve_types(path, names, types, inodes) + (offset,)
+else:
+    iter_listdir_typed = _iter_listdir_typed_scandir
+    listdir_typed_page = None
+
+
+def listdir_typed(path=unicode('.')):
+    """Like os.listdir(), but return a (names, types, inodes) tuple of
+    parallel lists, where types holds the DT_* constant of each entry.
+    Symlinks are not followed, DT_UNKNOWN entries are resolved with
+    lstat. No DirEntry object is created per name.
+    """
+    names = []
+    types = []
+    inodes = []
+    for chunk_names, chunk_types, chunk_inodes in iter_listdir_typed(path):
+        names.extend(chunk_names)
+        types.extend(chunk_types)
+        inodes.extend(chunk_inodes)
+    return names, types, inodes
+
+
 def _walk(top, topdown=True, onerror=None, followlinks=False):
     """Like Python 3.5's implementation of os.walk() -- faster than
     the pre-Python 3.5 version as it uses scandir() internally.
@@ -0,0 +1,385 @@
+"""Tests of the diskover_agent client module. They run without a
+storage agent, AgentConnection.listdir is replaced by a fake that lists
+an in-memory tree.
+"""
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import diskover_agent
+
+
+# dir -> subdirs
+TREE = {
+    '/remote': ['a', 'd', 'e'],
+    '/remote/a': ['b'],
+    '/remote/a/b': ['c'],
+    '/remote/a/b/c': [],
+    '/remote/d': ['f', 'g'],
+    '/remote/d/f': [],
+    '/remote/d/g': [],
+    '/remote/e': [],
+}
+# dir -> files, 'file' for dirs not listed
+FILES = {}
+
+
+def fake_listdir(self, path, stat=False, validators=None, filters=None):
+    dirs, files = list(TREE[path]), FILES.get(path, ['file'])
+    if stat:
+        dirs = [stat_entry(d, 'd') for d in dirs]
+        files = [stat_entry(f, 'f') for f in files]
+    return path, dirs, files
+
+
+def stat_entry(name, type):
+    return diskover_agent.StatEntry(name, type, 0, 0.0, 0.0, 0.0, 1, 1, 0, 0)
+
+
+class FakeAgentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.listdir = diskover_agent.AgentConnection.listdir
+        diskover_agent.AgentConnection.listdir = fake_listdir
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        diskover_agent.AgentConnection.listdir = self.listdir
+        shutil.rmtree(self.tmpdir)
+
+
+class WalkCheckpointTest(FakeAgentTestCase):
+
+    def walk(self, checkpoint, count=None):
+        walker = diskover_agent.parallel_walk('/remote', workers=2, hosts=['localhost'],
+                                              checkpoint=checkpoint, batchsize=1)
+        roots = []
+        for root, dirs, files in walker:
+            roots.append(root)
+            if len(roots) == count:
+                walker.close()
+                break
+        return roots
+
+    def test_resume_does_not_list_done_dirs_again(self):
+        checkpoint = os.path.join(self.tmpdir, 'walk.db')
+        first = self.walk(checkpoint, 3)
+        resumed = self.walk(checkpoint)
+        self.assertEqual(len(resumed), len(set(resumed)))
+        # the dirs yielded before the last one are done
+        self.assertFalse(set(first[:2]) & set(resumed))
+        self.assertEqual(set(first) | set(resumed), set(TREE))
+
+    def test_completed_walk_clears_checkpoint(self):
+        checkpoint = os.path.join(self.tmpdir, 'walk.db')
+        self.assertEqual(sorted(self.walk(checkpoint)), sorted(TREE))
+        self.assertEqual(sorted(self.walk(checkpoint)), sorted(TREE))
+
+    def test_done_before_parent_recorded(self):
+        ckpt = diskover_agent.WalkCheckpoint(os.path.join(self.tmpdir, 'walk.db'), '/remote')
+        ckpt.record('/remote/a/b', ['/remote/a/b/c'])
+        ckpt.commit()
+        ckpt.record('/remote', ['/remote/a'])
+        ckpt.record('/remote/a', ['/remote/a/b'])
+        ckpt.close()
+        ckpt = diskover_agent.WalkCheckpoint(os.path.join(self.tmpdir, 'walk.db'), '/remote')
+        self.assertEqual(ckpt.frontier(), ['/remote/a/b/c'])
+        self.assertEqual(sorted(ckpt.completed()), ['/remote', '/remote/a', '/remote/a/b'])
+        ckpt.close()
+
+    def test_paths_that_are_not_utf8(self):
+        ckpt = diskover_agent.WalkCheckpoint(os.path.join(self.tmpdir, 'walk.db'), '/remote')
+        name = diskover_agent.fsname(b'/remote/dir\xfe')
+        ckpt.record('/remote', [name])
+        ckpt.close()
+        ckpt = diskover_agent.WalkCheckpoint(os.path.join(self.tmpdir, 'walk.db'), '/remote')
+        self.assertEqual(ckpt.frontier(), [name])
+        ckpt.close()
+
+    def test_other_top(self):
+        path = os.path.join(self.tmpdir, 'walk.db')
+        diskover_agent.WalkCheckpoint(path, '/remote').close()
+        self.assertRaises(ValueError, diskover_agent.WalkCheckpoint, path, '/other')
+
+
+class ParallelWalkTest(FakeAgentTestCase):
+
+    def test_failed_listing_skipped(self):
+        def listdir(self, path, stat=False, validators=None, filters=None):
+            if path == '/remote/d':
+                raise ValueError("malformed listing")
+            if validators is not None:
+                validators[path] = 'etag'
+            return fake_listdir(self, path, stat)
+        diskover_agent.AgentConnection.listdir = listdir
+        warnings.simplefilter('ignore')
+        try:
+            validators = {'/remote/d': 'old'}
+            roots = [root for root, dirs, files in
+                     diskover_agent.parallel_walk('/remote', workers=4, hosts=['h1', 'h2'],
+                                                  validators=validators)]
+        finally:
+            warnings.resetwarnings()
+        self.assertEqual(sorted(roots), sorted(p for p in TREE if not p.startswith('/remote/d')))
+        self.assertFalse('/remote/d' in validators)
+
+    def test_host_budgets(self):
+        budgets = diskover_agent.host_budgets(['h1', 'h2', 'h3'], 40, {'h1': 2})
+        self.assertEqual(list(budgets.values()), [20, 10, 10])
+        self.assertEqual(dict(diskover_agent.host_budgets(['h1', 'h2'], 1)), {'h1': 1, 'h2': 1})
+        self.assertEqual(dict(diskover_agent.host_budgets(['h1', 'h2'], {'h1': 3})), {'h1': 3})
+
+    def test_pool_holds_all_workers(self):
+        # stealing and failover can send every worker to one host
+        sizes = []
+        adapter = diskover_agent.requests.adapters.HTTPAdapter
+
+        class RecordingAdapter(adapter):
+            def __init__(self, *args, **kwargs):
+                sizes.append(kwargs.get('pool_maxsize'))
+                adapter.__init__(self, *args, **kwargs)
+
+        diskover_agent.requests.adapters.HTTPAdapter = RecordingAdapter
+        try:
+            list(diskover_agent.parallel_walk('/remote', workers=12, hosts=['h1', 'h2', 'h3'],
+                                              weights={'h1': 4}, batchsize=1))
+        finally:
+            diskover_agent.requests.adapters.HTTPAdapter = adapter
+        self.assertEqual(sizes, [12])
+
+
+class IncrementalWalkTest(FakeAgentTestCase):
+
+    def walk(self, **kwargs):
+        index = os.path.join(self.tmpdir, 'walk.idx')
+        return dict((delta.path, delta) for delta in
+                    diskover_agent.incremental_walk('/remote', index, hosts=['localhost'],
+                                                    workers=2, **kwargs))
+
+    def tearDown(self):
+        FILES.clear()
+        FakeAgentTestCase.tearDown(self)
+
+    def test_changes(self):
+        first = self.walk()
+        self.assertEqual(sorted(first), sorted(TREE))
+        self.assertEqual(first['/remote'].added_dirs, ['a', 'd', 'e'])
+        self.assertEqual(self.walk(), {})
+        FILES['/remote/e'] = ['new']
+        delta = self.walk()['/remote/e']
+        self.assertEqual((delta.added_files, delta.removed_files), (['new'], ['file']))
+
+    def test_stat(self):
+        first = self.walk(stat=True)
+        self.assertEqual(sorted(first), sorted(TREE))
+        delta = first['/remote']
+        self.assertEqual(sorted(e.name for e in delta.added_dirs), ['a', 'd', 'e'])
+        self.assertEqual([(e.name, e.type) for e in delta.added_files], [('file', 'f')])
+        self.assertEqual(self.walk(stat=True), {})
+        FILES['/remote/e'] = ['new']
+        delta = self.walk(stat=True)['/remote/e']
+        self.assertEqual([e.name for e in delta.added_files], ['new'])
+        self.assertEqual(delta.removed_files, ['file'])
+
+
+class FakeResponse(object):
+
+    headers = {'content-type': 'text/plain'}
+
+    def __init__(self, content):
+        self.content = content
+        self.text = content.decode('utf-8')
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), 7):
+            yield self.content[i:i+7]
+
+
+class TextStatListingTest(unittest.TestCase):
+    """A name with a newline splits its line in a text stat listing."""
+
+    def setUp(self):
+        warnings.simplefilter('ignore')
+        self.c = diskover_agent.AgentConnection(hosts=['h1'])
+
+    def tearDown(self):
+        warnings.resetwarnings()
+
+    def test_parse_stat_line(self):
+        entry = diskover_agent.parse_stat_line('f\t5\t1.0\t2.0\t3.0\t7\t1\t0\t0\tna\tme')
+        self.assertEqual((entry.name, entry.type, entry.st_size), ('na\tme', 'f', 5))
+        for line in ('tail of name', 'f\t5\t1.0\t2.0\t3.0\t7\t1\t0\t0',
+                     'f\tx\t1.0\t2.0\t3.0\t7\t1\t0\t0\tname'):
+            self.assertEqual(diskover_agent.parse_stat_line(line), None)
+
+    def test_malformed_lines_skipped(self):
+        listing = (b'd\t0\t1.0\t2.0\t3.0\t7\t2\t0\t0\tdir\n'
+                   b'f\t5\t1.0\t2.0\t3.0\t8\t1\t0\t0\tbad\nname\n'
+                   b'f\t6\t1.0\t2.0\t3.0\t9\t1\t0\t0\tfile\n')
+        self.c.r = FakeResponse(listing)
+        dirs, files = self.c.parse_listing(True)
+        self.assertEqual([e.name for e in dirs], ['dir'])
+        self.assertEqual([e.name for e in files], ['bad', 'file'])
+        self.c.r = FakeResponse(b'/remote\n' + listing + b'\n')
+        records = list(self.c._walk_text(True))
+        self.assertEqual(len(records), 1)
+        root, dirs, files = records[0]
+        self.assertEqual(root, '/remote')
+        self.assertEqual([e.name for e in files], ['bad', 'file'])
+
+
+class LoadBalancerTest(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter('ignore')
+
+    def tearDown(self):
+        warnings.resetwarnings()
+
+    def eject(self, lb, host):
+        for i in range(lb.maxfails):
+            lb.outstanding[host] += 1
+            lb.fail(host)
+
+    def test_strategies_pick_hosts(self):
+        hosts = ['h1', 'h2', 'h3']
+        for strategy in diskover_agent.LoadBalancer.STRATEGIES:
+            lb = diskover_agent.LoadBalancer(hosts, strategy)
+            for i in range(20):
+                host = lb.acquire(path='/mnt/a/b/c%d' % i)
+                self.assertTrue(host in hosts)
+                lb.release(host, 0.01)
+        self.assertRaises(ValueError, diskover_agent.LoadBalancer, hosts, 'bogus')
+
+    def test_least_outstanding(self):
+        lb = diskover_agent.LoadBalancer(['h1', 'h2'], 'least')
+        self.assertEqual(set([lb.acquire(), lb.acquire()]), set(['h1', 'h2']))
+        lb.release('h2')
+        self.assertEqual(lb.acquire(), 'h2')
+
+    def test_ejection_and_probe(self):
+        lb = diskover_agent.LoadBalancer(['h1', 'h2'], 'random', ejecttime=0.05)
+        self.eject(lb, 'h1')
+        for i in range(10):
+            self.assertEqual(lb.choose(), 'h2')
+        time.sleep(0.06)
+        # a single request probes the host once its ejection ends
+        self.assertEqual(lb.acquire(exclude=['h2']), 'h1')
+        self.assertEqual(lb.choose(exclude=['h2']), None)
+        lb.release('h1')
+        self.assertEqual(lb.choose(exclude=['h2']), 'h1')
+
+    def test_failed_probe_ejects_again(self):
+        lb = diskover_agent.LoadBalancer(['h1', 'h2'], 'random', ejecttime=0.05)
+        self.eject(lb, 'h1')
+        time.sleep(0.06)
+        self.assertEqual(lb.acquire(exclude=['h2']), 'h1')
+        lb.fail('h1')
+        self.assertTrue(lb.ejected['h1'] > time.time())
+
+    def test_all_ejected_probes_soonest(self):
+        lb = diskover_agent.LoadBalancer(['h1', 'h2'], 'random', ejecttime=30)
+        self.eject(lb, 'h2')
+        self.eject(lb, 'h1')
+        self.assertEqual(lb.acquire(), 'h2')
+        # h1 is the only host without a probe in flight
+        self.assertEqual(lb.acquire(), 'h1')
+        self.assertEqual(lb.acquire(exclude=['h1', 'h2']), None)
+
+    def test_single_probe_in_flight(self):
+        lb = diskover_agent.LoadBalancer(['h1'], 'random', ejecttime=30)
+        self.eject(lb, 'h1')
+        self.assertEqual(lb.acquire(), 'h1')
+        result = []
+        t = threading.Thread(target=lambda: result.append(lb.acquire()))
+        t.start()
+        time.sleep(0.1)
+        # the second request waits for the probe
+        self.assertEqual(result, [])
+        lb.release('h1')
+        t.join(5)
+        self.assertEqual(result, ['h1'])
+        self.assertFalse('h1' in lb.ejected)
+
+    def test_exclude_all(self):
+        lb = diskover_agent.LoadBalancer(['h1'], 'hash')
+        self.assertEqual(lb.acquire(exclude=['h1'], path='/a'), None)
+
+
+class HashRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hosts = ['h%d' % i for i in range(5)]
+        self.ring = diskover_agent.HashRing(self.hosts, depth=2)
+        self.paths = ['/mnt/d%d/sub%d' % (i % 50, i) for i in range(500)]
+
+    def owner(self, ring, path):
+        return next(ring.hosts(path))
+
+    def test_same_prefix_same_host(self):
+        for i in range(50):
+            self.assertEqual(self.owner(self.ring, '/mnt/d%d/a' % i),
+                             self.owner(self.ring, '/mnt/d%d/b/c/d' % i))
+        self.assertEqual(self.ring.key('/mnt/d1/a/b'), 'mnt/d1')
+
+    def test_hosts_yields_each_once(self):
+        for path in self.paths[:50]:
+            self.assertEqual(sorted(self.ring.hosts(path)), self.hosts)
+        self.assertEqual(list(diskover_agent.HashRing().hosts('/mnt')), [])
+
+    def test_remove_moves_only_its_paths(self):
+        before = dict((p, self.owner(self.ring, p)) for p in self.paths)
+        self.ring.remove('h2')
+        for path in self.paths:
+            if before[path] != 'h2':
+                self.assertEqual(self.owner(self.ring, path), before[path])
+            else:
+                self.assertNotEqual(self.owner(self.ring, path), 'h2')
+        self.ring.add('h2')
+        after = dict((p, self.owner(self.ring, p)) for p in self.paths)
+        self.assertEqual(after, before)
+
+    def test_hash_strategy_falls_back(self):
+        lb = diskover_agent.LoadBalancer(self.hosts, 'hash', ring=self.ring)
+        path = '/mnt/d7/x'
+        order = list(self.ring.hosts(path))
+        self.assertEqual(lb.choose(path=path), order[0])
+        self.assertEqual(lb.choose(exclude=[order[0]], path=path), order[1])
+
+
+class TimeoutTest(unittest.TestCase):
+    """A host that accepts connections but never responds."""
+
+    def setUp(self):
+        warnings.simplefilter('ignore')
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+
+    def tearDown(self):
+        self.sock.close()
+        warnings.resetwarnings()
+
+    def test_read_timeout_fails_host(self):
+        lb = diskover_agent.LoadBalancer(['127.0.0.1'], maxfails=1)
+        c = diskover_agent.AgentConnection(hosts=['127.0.0.1'], port=self.port,
+                                           balancer=lb, timeout=(1, 0.2))
+        c.connect()
+        start = time.time()
+        self.assertEqual(c.listdir('/mnt/a'), None)
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue('127.0.0.1' in lb.ejected)
+
+
+if __name__ == '__main__':
+    unittest.main()
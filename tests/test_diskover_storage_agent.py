@@ -0,0 +1,111 @@
+"""Tests of the diskover_storage_agent server functions. The module
+parses its options when imported, so sys.argv is set up first.
+"""
+
+import collections
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+argv = sys.argv
+sys.argv = ['diskover_storage_agent.py', '-r', '/remote', '/local']
+try:
+    import diskover_storage_agent as agent
+finally:
+    sys.argv = argv
+
+try:
+    import diskover_agent as client
+except ImportError:
+    # the client needs requests
+    client = None
+
+Stat = collections.namedtuple('Stat', [field for field, code in agent.BINARY_STAT_FIELDS])
+
+
+class CursorTest(unittest.TestCase):
+
+    def test_offset_round_trip(self):
+        for offset in (0, 1, 2 ** 63 - 1):
+            cursor = agent.encode_cursor(b'o', str(offset).encode('ascii'))
+            self.assertEqual(agent.decode_cursor(cursor), (b'o', offset))
+
+    def test_name_round_trip(self):
+        cursor = agent.encode_cursor(b'n', b'name\xfe\n')
+        self.assertEqual(agent.decode_cursor(cursor), (b'n', b'name\xfe\n'))
+
+    def test_unicode_cursor(self):
+        # parse_qs returns unicode query values on Python 2
+        cursor = agent.encode_cursor(b'o', b'42')
+        self.assertEqual(agent.decode_cursor(u'' + cursor), (b'o', 42))
+
+    def test_invalid(self):
+        for cursor in ('', '@@', 'b', u'\xe9',
+                       agent.encode_cursor(b'x', b'1'),
+                       agent.encode_cursor(b'n', b''),
+                       agent.encode_cursor(b'o', b'abc'),
+                       agent.encode_cursor(b'o', b'-5'),
+                       agent.encode_cursor(b'o', str(2 ** 63).encode('ascii'))):
+            self.assertRaises(ValueError, agent.decode_cursor, cursor)
+
+
+@unittest.skipIf(client is None, "requests is not installed")
+class BinaryFormatTest(unittest.TestCase):
+    """Blocks encoded by BinaryFormat and decoded by the client's
+    BinaryDecoder.
+    """
+
+    entries = [
+        (b'dir', True, Stat(0, 1.5, 2.5, 3.5, 10, 2, 1000, 100)),
+        (b'file\n\xc3\xa9', False, Stat(2 ** 40, 4.0, 5.0, 6.0, 2 ** 33, 1, 0, 0)),
+        (b'raw\xfe', False, Stat(7, 0.0, 0.0, 0.0, 11, 1, 65534, 65534)),
+    ]
+
+    def decode(self, data, chunk=None):
+        decoder = client.BinaryDecoder()
+        if chunk is None:
+            return decoder.feed(data)
+        blocks = []
+        for i in range(0, len(data), chunk):
+            blocks.extend(decoder.feed(data[i:i+chunk]))
+        self.assertEqual(decoder.buf, b'')
+        return blocks
+
+    def test_walk_record(self):
+        fmt = agent.BinaryFormat(False)
+        data = fmt.preamble + fmt.root(b'/remote/a') + fmt.entries(self.entries) \
+               + fmt.entries([]) + fmt.record_end
+        names = [client.fsname(name) for name, is_dir, st in self.entries]
+        expected = [(client.BLOCK_ROOT, '/remote/a'),
+                    (client.BLOCK_ENTRIES, (names[:1], names[1:])),
+                    (client.BLOCK_ENTRIES, ([], [])),
+                    (client.BLOCK_END, None)]
+        for chunk in (None, 1, 7):
+            self.assertEqual(self.decode(data, chunk), expected)
+
+    def test_stat_entries(self):
+        fmt = agent.BinaryFormat(True)
+        blocks = self.decode(fmt.preamble + fmt.status(404, b'/remote/x')
+                             + fmt.entries(self.entries), 5)
+        self.assertEqual(blocks[0], (client.BLOCK_STATUS, (404, '/remote/x')))
+        dirs, files = blocks[1][1]
+        decoded = dirs + files
+        self.assertEqual([e.type for e in decoded], ['d', 'f', 'f'])
+        for entry, (name, is_dir, st) in zip(decoded, self.entries):
+            self.assertEqual(client.fsbytes(entry.name), name)
+            self.assertEqual(tuple(entry[2:]), tuple(st))
+
+    def test_du(self):
+        fmt = agent.BinaryFormat(False)
+        blocks = self.decode(fmt.preamble + fmt.du(b'/remote', (1, 2, 3, 4, 5.5)), 3)
+        self.assertEqual(blocks, [(client.BLOCK_DU,
+                                   client.DuEntry('/remote', 1, 2, 3, 4, 5.5))])
+
+    def test_invalid_header(self):
+        self.assertRaises(ValueError, client.BinaryDecoder().feed, b'XXXX\x01\x00')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Tests of the typed listing functions added to scandir.py."""
+
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import scandir
+
+
+class TypedListingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for i in range(300):
+            open(os.path.join(self.path, 'file%d' % i), 'w').close()
+        for i in range(20):
+            os.mkdir(os.path.join(self.path, 'dir%d' % i))
+        if hasattr(os, 'symlink'):
+            os.symlink('file0', os.path.join(self.path, 'link'))
+        self.expected = {}
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if os.path.islink(path):
+                self.expected[name] = scandir.DT_LNK
+            elif os.path.isdir(path):
+                self.expected[name] = scandir.DT_DIR
+            else:
+                self.expected[name] = scandir.DT_REG
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_listdir_typed(self):
+        names, types, inodes = scandir.listdir_typed(self.path)
+        self.assertEqual(dict(zip(names, types)), self.expected)
+        self.assertEqual(len(inodes), len(names))
+
+    def test_iter_listdir_typed(self):
+        listing = {}
+        for names, types, inodes in scandir.iter_listdir_typed(self.path):
+            listing.update(zip(names, types))
+        self.assertEqual(listing, self.expected)
+
+    def test_listdir_typed_page(self):
+        if scandir.listdir_typed_page is None:
+            return
+        listing = {}
+        offset = 0
+        pages = 0
+        while offset is not None:
+            names, types, inodes, offset = scandir.listdir_typed_page(self.path, offset, 50)
+            self.assertTrue(len(names) <= 50)
+            for name in names:
+                self.assertFalse(name in listing)
+            listing.update(zip(names, types))
+            pages += 1
+        self.assertEqual(listing, self.expected)
+        self.assertTrue(pages > 1)
+
+
+class GetdentsGatingTest(unittest.TestCase):
+
+    def test_getdents_with_c_extension(self):
+        # the typed listings use getdents64 even when scandir() is the
+        # _scandir C extension
+        if scandir.SYS_getdents64 is None:
+            return
+        fake = types.ModuleType('_scandir')
+        fake.scandir = scandir.scandir
+        fake.DirEntry = scandir.DirEntry
+        saved = dict((name, sys.modules.get(name)) for name in ('_scandir', 'scandir'))
+        sys.modules['_scandir'] = fake
+        del sys.modules['scandir']
+        try:
+            module = __import__('scandir')
+            self.assertTrue(module.scandir is fake.scandir)
+            self.assertTrue(module.listdir_typed_page is not None)
+            self.assertTrue(module.iter_listdir_typed is not module._iter_listdir_typed_scandir)
+        finally:
+            for name, module in saved.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+
+
+if __name__ == '__main__':
+    unittest.main()